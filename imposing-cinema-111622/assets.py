@@ -0,0 +1,77 @@
+# assets.py
+# This .py file builds the static asset bundles. It is run before deploying and is not itself
+# deployed (see skip_files in app.yaml).
+# Each bundle in BUNDLES is the concatenation of its files under static/ (files that are not
+# already minified are minified) and is written to static/dist/<name>.<content hash>.<ext>.
+# The file names of the current bundles are saved in assets.json, which the asset_url
+# template helper (main.py) reads. A bundle's URL changes whenever its content does, so
+# /static/dist/ is served with year-long, immutable cache headers (see app.yaml) and browsers
+# never request a bundle twice.
+# Earlier bundles are kept: pages cached by browsers (revisions are cached for a year) still
+# link to them.
+#
+# Usage:
+#   python assets.py
+# Commit static/dist/ and assets.json with the changed sources.
+
+import hashlib
+import json
+import os
+import re
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+DIST = 'dist'
+MANIFEST = os.path.join(APP_DIR, 'assets.json')
+HASH_LENGTH = 12
+
+# {bundle name: files (relative to static/) in the order they are concatenated}
+BUNDLES = {'site.css': ['css/bootstrap.min.css',
+						'css/styles.css']}
+
+
+# The minify_css function removes comments (other than /*! license comments) and whitespace
+# that does not change the meaning of the style sheet.
+def minify_css(css):
+	css = re.sub(r'/\*(?!!).*?\*/', '', css, flags=re.S)
+	css = re.sub(r'\s+', ' ', css)
+	css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+	# (a space before a colon is a descendant selector, a space after one is never needed)
+	css = re.sub(r':\s+', ':', css)
+	return css.replace(';}', '}').strip()
+
+# JavaScript is only concatenated; bundle the minified (.min.js) version of scripts.
+MINIFIERS = {'.css': minify_css}
+
+def bundle(name, files):
+	ext = os.path.splitext(name)[1]
+	minify = MINIFIERS.get(ext)
+	parts = []
+	for f in files:
+		with open(os.path.join(STATIC_DIR, f)) as source:
+			data = source.read()
+		if minify and not f.endswith('.min' + ext):
+			data = minify(data)
+		parts.append(data.strip())
+	return (';\n' if ext == '.js' else '\n').join(parts) + '\n'
+
+def build():
+	dist = os.path.join(STATIC_DIR, DIST)
+	if not os.path.isdir(dist):
+		os.makedirs(dist)
+	manifest = {}
+	for name, files in sorted(BUNDLES.iteritems()):
+		data = bundle(name, files)
+		base, ext = os.path.splitext(name)
+		digest = hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+		filename = '%s.%s%s' % (base, digest, ext)
+		with open(os.path.join(dist, filename), 'wb') as f:
+			f.write(data)
+		manifest[name] = '%s/%s' % (DIST, filename)
+		print '%s -> static/%s (%d bytes)' % (name, manifest[name], len(data))
+	with open(MANIFEST, 'w') as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+		f.write('\n')
+
+if __name__ == '__main__':
+	build()
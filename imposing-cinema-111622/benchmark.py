@@ -0,0 +1,219 @@
+# benchmark.py
+# This .py file is a local load test and benchmark for the wiki. It is not deployed (see
+# skip_files in app.yaml).
+# main.app is run with the Flask test client against the App Engine testbed (local datastore,
+# memcache, task queue and user stubs). A corpus of pages, revisions and users is seeded, then
+# a mixed workload of requests is run and for every workload (and instrumented helper, see
+# stats.py) the throughput, latency percentiles and RPCs per request are reported.
+# The corpus and the sequence of requests only depend on the options (--seed), so the RPC
+# counts are reproducible and the latencies are comparable between runs on one machine.
+# Results can be saved (--output) and compared with a saved baseline (--baseline).
+#
+# Usage:
+#   python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine [options]
+# Run python benchmark.py --help for the options.
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# (name, weight) of the requests in the workload
+WORKLOAD = [('home', 25),
+			('view', 35),
+			('view_version', 10),
+			('edit', 5),
+			('history', 10),
+			('diff', 5),
+			('search', 5),
+			('index', 5),
+			('login', 10)]
+
+WORDS = ('wiki page houston texas river city history people music food art science '
+		 'school park road bridge museum library market festival team game').split()
+
+
+# The setup function makes the App Engine SDK, the vendored libraries and the app importable
+# and activates the testbed.
+def setup(sdk):
+	sys.path.insert(0, sdk)
+	import dev_appserver
+	dev_appserver.fix_sys_path()
+	sys.path.insert(0, APP_DIR)
+	sys.path.insert(0, os.path.join(APP_DIR, 'lib'))
+	from google.appengine.datastore import datastore_stub_util
+	from google.appengine.ext import testbed
+	tb = testbed.Testbed()
+	tb.activate()
+	tb.setup_env(app_id='imposing-cinema-111622')
+	# every write is immediately visible to queries (as in production for most reads)
+	policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+	tb.init_datastore_v3_stub(consistency_policy=policy)
+	tb.init_memcache_stub()
+	tb.init_taskqueue_stub(root_path=APP_DIR)
+	tb.init_user_stub()
+	return tb
+
+
+def text(rnd, words):
+	lines = []
+	while words > 0:
+		n = min(rnd.randint(5, 15), words)
+		lines.append(' '.join(rnd.choice(WORDS) for i in xrange(n)))
+		words -= n
+	return '\n'.join(lines)
+
+def edit_text(rnd, old):
+	lines = old.split('\n')
+	i = rnd.randrange(len(lines))
+	lines[i] = text(rnd, rnd.randint(5, 15))
+	return '\n'.join(lines)
+
+def tags(options):
+	return ['Page_%d' % i for i in xrange(options.pages)]
+
+def usernames(options):
+	return ['user%d' % i for i in xrange(options.users)]
+
+
+# The seed function saves the corpus: options.users users and options.pages pages with
+# options.revisions revisions each.
+def seed(options, rnd):
+	from entities import Page, User
+	from search import index_page
+	for name in usernames(options):
+		User.register(name, 'password')
+	for tag in tags(options):
+		content = text(rnd, options.words)
+		for r in xrange(options.revisions):
+			Page.save(tag, content, rnd.choice(usernames(options)))
+			content = edit_text(rnd, content)
+		index_page(tag)
+
+
+# The request function makes one request of the workload and returns the response status
+def request(name, client, editor, options, rnd):
+	from main import app
+	tag = rnd.choice(tags(options))
+	if name == 'home':
+		r = client.get('/')
+	elif name == 'view':
+		r = client.get('/wiki/%s' % tag)
+	elif name == 'view_version':
+		r = client.get('/wiki/%s?v=%d' % (tag, rnd.randint(1, options.revisions)))
+	elif name == 'edit':
+		content = text(rnd, options.words)
+		r = editor.post('/edit/%s' % tag, data={'content': content})
+	elif name == 'history':
+		r = client.get('/history/%s' % tag)
+	elif name == 'diff':
+		r = client.get('/diff/%s?to=%d' % (tag, rnd.randint(2, max(options.revisions, 2))))
+	elif name == 'search':
+		r = client.get('/search?q=%s+%s' % (rnd.choice(WORDS), rnd.choice(WORDS)))
+	elif name == 'index':
+		r = client.get('/index?prefix=%s' % tag[:6])
+	elif name == 'login':
+		r = app.test_client().post('/login', data={'username': rnd.choice(usernames(options)),
+												   'password': 'password'})
+	return r.status_code
+
+def choose(rnd):
+	n = rnd.randrange(sum(w for name, w in WORKLOAD))
+	for name, w in WORKLOAD:
+		if n < w:
+			return name
+		n -= w
+
+
+# The run function runs options.requests requests of the workload and returns the stats
+# summary and the total wall time.
+def run(options, rnd):
+	from google.appengine.ext import ndb
+	from main import app
+	import stats
+	# keep the samples of every request
+	stats.SAMPLES = max(options.requests, options.warmup)
+	client = app.test_client()
+	editor = app.test_client()
+	with editor.session_transaction() as session:
+		session['username'] = usernames(options)[0]
+	for phase, count in [('warmup', options.warmup), ('run', options.requests)]:
+		stats.reset()
+		start = time.time()
+		for i in xrange(count):
+			name = choose(rnd)
+			# every request gets a new ndb context (and in-context cache) as in production
+			ndb.get_context().clear_cache()
+			timer = stats.Timer()
+			status = request(name, client, editor, options, rnd)
+			stats.record('workload:' + name, timer.stop())
+			if status >= 500:
+				raise Exception('%s returned %d' % (name, status))
+		elapsed = time.time() - start
+	return stats.summary(), elapsed
+
+
+# The report function prints the stats of every workload and helper. Throughput is the number
+# of requests per second a single thread serves (1000 / mean ms). RPCs are means per request.
+def report(summary, elapsed, options, baseline = None):
+	print '%d requests in %.1fs (%.1f requests/s)' % (options.requests, elapsed,
+													   options.requests / elapsed)
+	print
+	header = '%-28s %7s %9s %9s %9s %9s %9s %9s' % ('name', 'count', 'req/s', 'p50 ms',
+		'p90 ms', 'p99 ms', 'datastore', 'memcache')
+	for workload in (True, False):
+		print header
+		for name in sorted(summary):
+			if name.startswith('workload:') != workload:
+				continue
+			s = summary[name]
+			line = '%-28s %7d %9.1f %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+				name, s['count'], 1000.0 / max(s['ms']['mean'], 0.001), s['ms']['p50'],
+				s['ms']['p90'], s['ms']['p99'], s['datastore']['mean'], s['memcache']['mean'])
+			if baseline and name in baseline:
+				b = baseline[name]
+				line += '   (p50 ms %+.2f, datastore %+.2f, memcache %+.2f)' % (
+					s['ms']['p50'] - b['ms']['p50'],
+					s['datastore']['mean'] - b['datastore']['mean'],
+					s['memcache']['mean'] - b['memcache']['mean'])
+			print line
+		print
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the wiki against local stubs.')
+	parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+						help='path to the App Engine Python SDK (or set APPENGINE_SDK)')
+	parser.add_argument('--pages', type=int, default=100)
+	parser.add_argument('--revisions', type=int, default=20, help='revisions per page')
+	parser.add_argument('--words', type=int, default=500, help='words per page')
+	parser.add_argument('--users', type=int, default=20)
+	parser.add_argument('--requests', type=int, default=2000)
+	parser.add_argument('--warmup', type=int, default=200)
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--output', help='save the results (JSON) to this file')
+	parser.add_argument('--baseline', help='compare with results saved with --output')
+	options = parser.parse_args()
+	tb = setup(options.sdk)
+	try:
+		rnd = random.Random(options.seed)
+		seed(options, rnd)
+		summary, elapsed = run(options, rnd)
+	finally:
+		tb.deactivate()
+	baseline = None
+	if options.baseline:
+		with open(options.baseline) as f:
+			baseline = json.load(f)['summary']
+	report(summary, elapsed, options, baseline)
+	if options.output:
+		with open(options.output, 'w') as f:
+			json.dump({'options': vars(options), 'elapsed': elapsed, 'summary': summary}, f,
+					  indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,165 @@
+# diff.py
+# This .py file contains the line and word diff of two texts (used by the /diff route).
+# Lines are matched with a patience diff:
+#   -- lines common to the start and end of the texts are matched
+#   -- lines that appear exactly once in both texts are anchors; the longest sequence of
+#      anchors that are in the same order in both texts is matched (O(n log n))
+#   -- the same is done for the lines between each pair of anchors
+#   -- regions with no anchors left are matched with difflib if they are small
+#      (SMALL_REGION), otherwise they are shown as replaced
+# so a diff takes about linear time even for texts near the 1 MB TextProperty limit, where
+# difflib.SequenceMatcher alone can take quadratic time.
+# Changed lines are paired and diffed by word (lines up to WORD_DIFF_CHARS long) with the same
+# patience diff. At most WORD_DIFF_BUDGET characters are diffed by word per diff; changed lines
+# after that (in large rewrites) are marked as a whole.
+# This file should not contain app specific functions
+
+import bisect
+import difflib
+import re
+
+CONTEXT = 3
+SMALL_REGION = 10000
+WORD_DIFF_CHARS = 2000
+WORD_DIFF_BUDGET = 100000
+WORD_RE = re.compile(r'\w+|\s+|[^\w\s]', re.UNICODE)
+
+
+# The line_opcodes function returns the difflib style opcodes (op, i1, i2, j1, j2) that turn
+# the lines a into the lines b.
+def line_opcodes(a, b):
+	matches = []
+	regions = [(0, len(a), 0, len(b))]
+	while regions:
+		alo, ahi, blo, bhi = regions.pop()
+		while alo < ahi and blo < bhi and a[alo] == b[blo]:
+			matches.append((alo, blo))
+			alo, blo = alo + 1, blo + 1
+		while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+			ahi, bhi = ahi - 1, bhi - 1
+			matches.append((ahi, bhi))
+		if alo == ahi or blo == bhi:
+			continue
+		anchors = _anchors(a, b, alo, ahi, blo, bhi)
+		if anchors:
+			matches.extend(anchors)
+			for i, j in anchors:
+				regions.append((alo, i, blo, j))
+				alo, blo = i + 1, j + 1
+			regions.append((alo, ahi, blo, bhi))
+		elif (ahi - alo) * (bhi - blo) <= SMALL_REGION:
+			matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+			for i, j, n in matcher.get_matching_blocks():
+				matches.extend((alo + i + k, blo + j + k) for k in xrange(n))
+	return _opcodes(sorted(matches), len(a), len(b))
+
+# The anchors are the longest sequence of lines unique in both a[alo:ahi] and b[blo:bhi]
+# that are in the same order in both (patience sorting).
+def _anchors(a, b, alo, ahi, blo, bhi):
+	counts = {}
+	for i in xrange(alo, ahi):
+		n = counts.get(a[i], (0, 0, 0))
+		counts[a[i]] = (n[0] + 1, n[1], i)
+	for j in xrange(blo, bhi):
+		n = counts.get(b[j])
+		if n:
+			counts[b[j]] = (n[0], n[1] + 1, n[2])
+	unique = [(i, j) for i, j in
+			  ((counts[b[j]][2], j) for j in xrange(blo, bhi) if b[j] in counts)
+			  if counts[a[i]][:2] == (1, 1)]
+	unique.sort()
+	# tails[k] is the smallest j ending an increasing sequence of length k + 1
+	tails, ends, previous = [], [], []
+	for n, (i, j) in enumerate(unique):
+		k = bisect.bisect_left(tails, j)
+		previous.append(ends[k - 1] if k else None)
+		if k == len(tails):
+			tails.append(j)
+			ends.append(n)
+		else:
+			tails[k] = j
+			ends[k] = n
+	anchors = []
+	n = ends[-1] if ends else None
+	while n is not None:
+		anchors.append(unique[n])
+		n = previous[n]
+	anchors.reverse()
+	return anchors
+
+def _opcodes(matches, la, lb):
+	opcodes = []
+	i = j = 0
+	for mi, mj in matches + [(la, lb)]:
+		if i < mi and j < mj:
+			opcodes.append(('replace', i, mi, j, mj))
+		elif i < mi:
+			opcodes.append(('delete', i, mi, j, j))
+		elif j < mj:
+			opcodes.append(('insert', i, i, j, mj))
+		if mi < la:
+			if opcodes and opcodes[-1][0] == 'equal':
+				opcodes[-1] = ('equal', opcodes[-1][1], mi + 1, opcodes[-1][3], mj + 1)
+			else:
+				opcodes.append(('equal', mi, mi + 1, mj, mj + 1))
+		i, j = mi + 1, mj + 1
+	return opcodes
+
+
+# The diff_texts function returns the diff of two texts as a dictionary:
+#   -- 'rows': a list of (op, old line number, new line number, segments) where op is
+#      'equal', 'delete' or 'insert', a line number is None if the line is not in that text,
+#      and segments is a list of (changed, text). Unchanged lines more than CONTEXT lines from
+#      a change are left out and replaced by a ('skip', None, None, number of lines) row.
+#   -- 'added' and 'removed': the number of lines added and removed
+def diff_texts(old, new):
+	a, b = old.splitlines(), new.splitlines()
+	rows, added, removed = [], 0, 0
+	budget = WORD_DIFF_BUDGET
+	opcodes = line_opcodes(a, b)
+	for n, (op, i1, i2, j1, j2) in enumerate(opcodes):
+		if op == 'equal':
+			rows.extend(_context(a, i1, i2, j1, n > 0, n < len(opcodes) - 1))
+			continue
+		removed += i2 - i1
+		added += j2 - j1
+		old_rows, new_rows = [], []
+		for k in xrange(max(i2 - i1, j2 - j1)):
+			i, j = i1 + k, j1 + k
+			if i < i2 and j < j2 and len(a[i]) + len(b[j]) <= budget:
+				budget -= len(a[i]) + len(b[j])
+				old_segments, new_segments = word_diff(a[i], b[j])
+			elif i < i2 and j < j2:
+				old_segments, new_segments = [(True, a[i])], [(True, b[j])]
+			else:
+				old_segments = [(True, a[i])] if i < i2 else None
+				new_segments = [(True, b[j])] if j < j2 else None
+			if old_segments is not None:
+				old_rows.append(('delete', i + 1, None, old_segments))
+			if new_segments is not None:
+				new_rows.append(('insert', None, j + 1, new_segments))
+		rows.extend(old_rows)
+		rows.extend(new_rows)
+	return {'rows': rows, 'added': added, 'removed': removed}
+
+def _context(a, i1, i2, j1, before, after):
+	lines = [('equal', i + 1, j1 + i - i1 + 1, [(False, a[i])]) for i in xrange(i1, i2)]
+	head = lines[:CONTEXT] if before else []
+	tail = lines[-CONTEXT:] if after else []
+	if len(head) + len(tail) >= len(lines):
+		return lines
+	return head + [('skip', None, None, len(lines) - len(head) - len(tail))] + tail
+
+# The word_diff function returns the segments of an old and a new line, marking the words
+# that changed.
+def word_diff(old, new):
+	if len(old) > WORD_DIFF_CHARS or len(new) > WORD_DIFF_CHARS:
+		return [(True, old)], [(True, new)]
+	a, b = WORD_RE.findall(old), WORD_RE.findall(new)
+	old_segments, new_segments = [], []
+	for op, i1, i2, j1, j2 in line_opcodes(a, b):
+		if i2 > i1:
+			old_segments.append((op != 'equal', ''.join(a[i1:i2])))
+		if j2 > j1:
+			new_segments.append((op != 'equal', ''.join(b[j1:j2])))
+	return old_segments, new_segments
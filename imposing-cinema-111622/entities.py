@@ -5,24 +5,25 @@
 #	(1) May want to organize memchache a bit better.
 
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from datetime import datetime, timedelta
-from utils import make_pw_hash, valid_pw
+import time
+from utils import make_pw_hash, valid_pw, underscore_to_space, make_delta, apply_delta
+from diff import diff_texts
+from markup import render_html, render_html_multi
+from stats import timed
 
 
 # Page entity
 # The Page entity represents rows of versions of wiki page content
 
-# The wiki_key function returns the parent key for wikis.
-# Having a parent key guarantees consistency when querying immediately after creation (?)
+# The wiki_key function returns the parent key that pages were stored under before each
+# page became its own entity group. A single parent capped writes to about one per second
+# for the entire wiki; it is only used to migrate pages stored under it.
 def wiki_key(name = 'default'):
 	return ndb.Key('wikis', name)
 
-def newest_pages():
-	pages = Page.query(ancestor=wiki_key()).order(-Page.created).fetch(10)
-	pages = list(pages)
-	return pages
-
 class Page(ndb.Model):
 	tag = ndb.StringProperty(required = True)
 		# doubles as the URL?
@@ -33,13 +34,139 @@ class Page(ndb.Model):
 		# the page is considered to be modified when a new content instance is created
 	edits = ndb.IntegerProperty(required = True)
 	    # the number of content pages is stored. Updated this value forces modified to update
+	content = ndb.TextProperty()
+		# copy of the most recent Content.content so a page is displayed with a single get
+	snapshot = ndb.IntegerProperty()
+		# revision id of the most recent Content snapshot (see Content)
+
 
+	# Pages are root entities keyed by their tag, so a page lookup is a single strongly
+	# consistent get, two users creating the same page at the same time create a single
+	# entity, and each page (with its content) is its own entity group.
 
 	# The by_tag classmethod returns the page object corresponding to the tag
 	@classmethod
+	@timed('Page.by_tag')
 	def by_tag(cls, tag):
-		p = cls.query(cls.tag==tag).get()
-		return p
+		return cls.get_by_id(tag)
+
+	# The save classmethod saves new content for the page with the tag, creating the page if
+	# it does not exist. It returns the saved page and whether the page was created.
+	# Raises TransactionFailedError if the page could not be saved because of concurrent saves.
+	@classmethod
+	@timed('Page.save')
+	def save(cls, tag, content, author):
+		return _save_content_async(tag, content, author).get_result()
+
+	# The add_revision method adds a new revision to the page and returns its (unsaved)
+	# Content entity. The page and the Content entity need to be put together.
+	def add_revision(self, content, author, created = None):
+		# update the counter for number of saved edits for a page.
+		# This also forces the modified date property to update.
+		self.edits += 1
+		# the new revision is stored as a delta against the previous content (the copy on the
+		# page) unless a snapshot is due
+		c = Content(id=self.edits, author=author, parent=self.key)
+		if created:
+			c.created = created
+		c.summarize(content)
+		if (self.content is None or self.snapshot is None or
+				self.edits - self.snapshot >= SNAPSHOT_INTERVAL):
+			c.content = content
+			self.snapshot = self.edits
+		else:
+			c.delta = make_delta(self.content, content)
+			c.base = self.snapshot
+		self.content = content
+		return c
+
+
+# The page and its new content share an entity group, so the save is a single transaction.
+# The page read-modify-write happens inside the transaction, so concurrent saves are retried
+# instead of losing increments of Page.edits, and the Page and Content writes are issued
+# together as one batched RPC.
+# The search index task (see search.index_page) is added in the same transaction, so it is
+# queued if and only if the save commits.
+INDEX_TASK_URL = '/_tasks/index'
+
+@ndb.transactional_tasklet
+def _save_content_async(tag, content, author):
+	p = yield Page.get_by_id_async(tag)
+	created = p is None
+	if created:
+		p = Page(id=tag, tag=tag, owner=author, edits=0)
+	c = p.add_revision(content, author)
+	taskqueue.add(url=INDEX_TASK_URL, params={'tag': tag}, transactional=True)
+	yield ndb.put_multi_async([p, c])
+	raise ndb.Return(p, created)
+
+
+# The migrate_pages function moves Page entities stored under wiki_key (numeric or tag ids)
+# to root entities keyed by tag. Content entities are moved under the new Page, duplicate
+# pages created for the same tag are merged, and pages without a copy of their newest
+# content get one. Pages are migrated in batches; the urlsafe cursor for the next batch is
+# returned (None when the migration is complete).
+# A page's Content entities are moved MIGRATE_CONTENT_BATCH at a time (a transaction writes at
+# most 10 MB and a revision can be 1 MB), then the Page itself is moved. Every step is its own
+# transaction, so a migration that is interrupted can be run again.
+MIGRATE_CONTENT_BATCH = 5
+
+def migrate_pages(cursor = None, batch = 10):
+	cursor = Cursor(urlsafe=cursor) if cursor else None
+	pages, cursor, more = Page.query(ancestor=wiki_key()).fetch_page(batch, start_cursor=cursor)
+	for old in pages:
+		new_key = ndb.Key(Page, old.tag)
+		while True:
+			keys = Content.query(ancestor=old.key).fetch(MIGRATE_CONTENT_BATCH, keys_only=True)
+			if not keys:
+				break
+			_migrate_contents(keys, new_key)
+		_migrate_page(old.key)
+	return cursor.urlsafe() if more else None
+
+# The migrate_contents function adds the summary properties used to list the page history
+# (see Content.summarize) to Content entities saved before they existed.
+def migrate_contents(cursor = None, batch = 100):
+	cursor = Cursor(urlsafe=cursor) if cursor else None
+	contents, cursor, more = Content.query().fetch_page(batch, start_cursor=cursor)
+	contents = [c for c in contents if c.size is None]
+	for c, text in zip(contents, content_texts(contents)):
+		c.summarize(text)
+	ndb.put_multi(contents)
+	return cursor.urlsafe() if more else None
+
+# The old and new pages are in different entity groups, so each move is a cross-group
+# transaction. Content entities are copied and deleted together, so none is copied twice.
+@ndb.transactional(xg = True)
+def _migrate_contents(keys, new_key):
+	contents = [c for c in ndb.get_multi(keys) if c]
+	ndb.put_multi([Content(parent=new_key, content=c.content, author=c.author, created=c.created)
+				   for c in contents])
+	ndb.delete_multi([c.key for c in contents])
+
+@ndb.transactional(xg = True)
+def _migrate_page(old_key):
+	old = old_key.get()
+	if not old:
+		return
+	p = Page.by_tag(old.tag)
+	if p:
+		# merge into the page that already has the tag key, keeping the first owner
+		if old.created < p.created:
+			p.owner, p.created = old.owner, old.created
+		p.edits += old.edits
+		# revision ids now skip the merged edits, so the next revision cannot be a delta
+		# (deltas are rebuilt from consecutive ids): it is saved as a snapshot
+		p.snapshot = None
+	else:
+		p = Page(id=old.tag, tag=old.tag, owner=old.owner, created=old.created,
+				 edits=old.edits, content=old.content)
+	if p.content is None:
+		# the contents were moved before the page (an ancestor query is strongly consistent)
+		newest = Content.query(ancestor=p.key).order(-Content.created).get()
+		p.content = newest.content if newest else None
+	p.put()
+	old.key.delete()
 
 
 # Content entity
@@ -49,58 +176,385 @@ class Page(ndb.Model):
 # created content entity is displayed for the page. A collection of content entities are
 # a history of the changes made to the content displayed at the Page entity URL.
 
-# Having a parent key guarantees consistency when querying immediately after creation (?)
+# Having the page as the parent key guarantees consistency when querying its content.
 # Improvements:
 #   (1) JSON?
 #   (2) Review process for Content changes. Changes are sent to Page.owner for review.
 #   (3) Cache some of the query results?
 # Organization:
 #   -- wikipages are organized with the following structure:
-#      /wikis
-#         /example-page-1 (Page entity)
-#            Content entity: example-page-1 revision 0 content
-#            Content entity: example-page-1 revision 1 content
-#            etc.
-#         /example-page-2 (Page entity)
-#            Content entity: example-page-2 revision 0 content
-#            Content entity: example-page-2 revision 1 content
-#            etc.
-#         /etc.
+#      /example-page-1 (Page entity)
+#         Content entity: example-page-1 revision 0 content
+#         Content entity: example-page-1 revision 1 content
+#         etc.
+#      /example-page-2 (Page entity)
+#         Content entity: example-page-2 revision 0 content
+#         Content entity: example-page-2 revision 1 content
+#         etc.
+#      /etc.
 #   -- the content of wikipage "A" is stored as a collection of Content entities at path
-#      /wikis/Page entity/
+#      /Page entity/
 #   -- the most recent Content entity is displayed for a given url (store only 10 most recent?)
+# Revisions:
+#   -- Content entities are keyed by revision id (1, 2, 3, ... the value of Page.edits when
+#      the content was saved). Content saved before revision ids has a datastore assigned id.
+#   -- every SNAPSHOT_INTERVAL revisions the full text is stored in Content.content
+#      (a snapshot). Other revisions store a compressed line delta against the previous
+#      revision in Content.delta and the revision id of their snapshot in Content.base.
+#   -- a revision is rebuilt from its snapshot and the deltas after it, which are fetched
+#      with one get_multi of at most SNAPSHOT_INTERVAL keys (see content_texts). The most
+#      recent revision never needs rebuilding since the page stores a copy of it.
+#   -- Content saved before deltas always stores the full text and stays readable.
+SNAPSHOT_INTERVAL = 10
 
 # get_content returns the most recent content for the page (content to be displayed)
+# Pages carry a copy of their most recent content; the Content query is only run for
+# pages saved before the copy was added.
+@timed('get_content')
 def get_content(page):
+	if page.content is not None:
+		return page.content
 	content = Content.query(ancestor=page.key).order(-Content.created).get()
-	return content
-
-def newest_page_updates():
-	pages = Page.query(ancestor=wiki_key()).order(-Page.modified).fetch(10)
-	pages = list(pages)
-	return pages
-
-def get_history(page):
-	history = Content.query(ancestor=page.key).order(-Content.created).fetch(10)
-	history = list(history)
-	return history
+	return content.content if content else None
+
+# get_history returns a page of the content history (newest first) and the urlsafe cursor
+# for the next page (None on the last page). The history is a projection query, so only the
+# summary properties of each revision are loaded, never the content.
+# Each revision is paired with the id of the revision before it (None for the first), which
+# is read with one more row of the query (revisions saved before revision ids do not have
+# consecutive ids).
+HISTORY_PAGE_SIZE = 20
+
+@timed('get_history')
+def get_history(page, cursor = None):
+	cursor = Cursor(urlsafe=cursor) if cursor else None
+	revisions = Content.query(ancestor=page.key).order(-Content.created).iter(
+		limit=HISTORY_PAGE_SIZE + 1, start_cursor=cursor, produce_cursors=True,
+		projection=[Content.created, Content.author, Content.size, Content.excerpt])
+	rows, cursor = [], None
+	for c in revisions:
+		if len(rows) == HISTORY_PAGE_SIZE:
+			cursor = revisions.cursor_before().urlsafe()
+		rows.append(c)
+	previous = [c.key.id() for c in rows[1:]] + [None]
+	return zip(rows, previous)[:HISTORY_PAGE_SIZE], cursor
+
+# previous_revision returns the id of the newest revision of the page saved before the
+# revision (the newest revision if revision is None), or None if there is no such revision.
+@timed('previous_revision')
+def previous_revision(page, revision = None):
+	query = Content.query(ancestor=page.key).order(-Content.created)
+	if revision is not None:
+		c = Content.get_by_id(revision, parent=page.key)
+		if not c:
+			return None
+		query = query.filter(Content.created < c.created)
+	key = query.get(keys_only=True)
+	return key.id() if key else None
+
+# get_revision returns the full text of a revision of the page, or None if the page has no
+# revision with that id. Revisions are fetched by key, never queried.
+@timed('get_revision')
+def get_revision(page, revision):
+	c = Content.get_by_id(revision, parent=page.key)
+	if c:
+		return content_texts([c])[0]
+
+# Revision diffs
+# Revisions never change, so the diff of two revisions is computed once and stored in memcache
+# at 'diff|<tag>|<from revision id>|<to revision id>' (it is never invalidated). The id of the
+# revision before the 'from' revision is stored with it (as 'previous') to link to the older
+# change.
+
+def diff_cache_key(tag, old, new):
+	return 'diff|%s|%s|%s' % (tag, old, new)
+
+# revision_diff returns the diff (see diff.diff_texts) of two revisions of the page, or None if
+# the page does not have both revisions. Both revisions are fetched in one get_multi.
+@timed('revision_diff')
+def revision_diff(page, old, new):
+	key = diff_cache_key(page.tag, old, new)
+	d = memcache.get(key)
+	if d is None:
+		contents = ndb.get_multi([ndb.Key(Content, r, parent=page.key) for r in (old, new)])
+		if None in contents:
+			return None
+		d = diff_texts(*content_texts(contents))
+		d['previous'] = previous_revision(page, old)
+		try:
+			memcache.set(key, d)
+		except ValueError:
+			# diffs of very large rewrites can exceed the memcache value size limit
+			pass
+	return d
+
+# content_texts returns the full text of each of the Content entities. Delta revisions are
+# rebuilt from their snapshot; the revisions needed for that are fetched in one get_multi.
+@timed('content_texts')
+def content_texts(contents):
+	revisions = dict((c.key, c) for c in contents)
+	missing = set()
+	for c in contents:
+		if c.delta is not None:
+			missing.update(ndb.Key(Content, r, parent=c.key.parent())
+						   for r in xrange(c.base, c.key.id()))
+	missing.difference_update(revisions)
+	for c in ndb.get_multi(list(missing)):
+		if c:
+			revisions[c.key] = c
+	texts = {}
+	def text(key):
+		if key not in texts:
+			c = revisions[key]
+			if c.delta is None:
+				texts[key] = c.content
+			else:
+				previous = ndb.Key(Content, key.id() - 1, parent=key.parent())
+				texts[key] = apply_delta(text(previous), c.delta)
+		return texts[key]
+	return [text(c.key) for c in contents]
 
 class Content(ndb.Model):
-	content = ndb.TextProperty(required = True)
-		# Text property stores up to 1 MB and cannot be indexed
+	content = ndb.TextProperty()
+		# Text property stores up to 1 MB and cannot be indexed. Only set for snapshots.
+	delta = ndb.JsonProperty(compressed = True)
+		# line delta against the previous revision (see utils.make_delta)
+	base = ndb.IntegerProperty()
+		# revision id of the snapshot a delta revision is rebuilt from
 	author = ndb.StringProperty(required = True)
 		# stores User.username (you must be a registered user to generate content) 
 	created = ndb.DateTimeProperty(auto_now_add = True)
+	size = ndb.IntegerProperty()
+		# number of characters in the revision
+	excerpt = ndb.StringProperty()
+		# beginning of the revision, shown when listing the page history
+
+	# The summarize method sets the properties used to list the revision in the page history
+	def summarize(self, text):
+		self.size = len(text)
+		self.excerpt = ' '.join(text[:EXCERPT_LENGTH * 2].split())[:EXCERPT_LENGTH]
+
+EXCERPT_LENGTH = 100
+
+
+# Page feeds
+# The 10 newest and 10 most recently updated pages are materialized in memcache at 'feeds' as
+#   {'newest': [...], 'updated': [...]}
+# lists of page summaries ({'tag', 'created', 'modified'}), so the home page is served with a
+# single memcache get and no queries. The edit handler pushes saved pages onto the feeds (see
+# push_page_feeds). The datastore is only queried to rebuild the feeds when memcache is empty;
+# pages are root entities, so those (projection) queries are eventually consistent.
+FEEDS_KEY = 'feeds'
+FEED_SIZE = 10
+FEED_ORDERS = {'newest': Page.created, 'updated': Page.modified}
+
+@timed('page_feeds')
+def page_feeds():
+	feeds = memcache.get(FEEDS_KEY)
+	if feeds is None:
+		feeds = _query_page_feeds()
+		memcache.add(FEEDS_KEY, feeds)
+	return feeds
+
+def _query_page_feeds():
+	futures = dict((name, Page.query().order(-order).fetch_async(FEED_SIZE,
+						projection=[Page.tag, Page.created, Page.modified]))
+				   for name, order in FEED_ORDERS.iteritems())
+	return dict((name, [page_summary(p) for p in f.get_result()])
+				for name, f in futures.iteritems())
+
+def page_summary(page):
+	return {'tag': page.tag, 'created': page.created, 'modified': page.modified}
+
+# The push_page_feeds function adds a saved page to the top of the feeds. A new page (created
+# is True) is added to both feeds; an edited page only to the 'updated' feed.
+# Compare-and-set keeps concurrent saves from overwriting each other's feed updates.
+@timed('push_page_feeds')
+def push_page_feeds(page, created = False):
+	summary = page_summary(page)
+	client = memcache.Client()
+	for retry in xrange(5):
+		feeds = client.gets(FEEDS_KEY)
+		if feeds is None:
+			if client.add(FEEDS_KEY, _push(_query_page_feeds(), summary, created)):
+				return
+		elif client.cas(FEEDS_KEY, _push(feeds, summary, created)):
+			return
+	client.delete(FEEDS_KEY)
+
+def _push(feeds, summary, created):
+	for name in FEED_ORDERS if created else ['updated']:
+		feeds[name] = [summary] + [p for p in feeds[name]
+								   if p['tag'] != summary['tag']][:FEED_SIZE - 1]
+	return feeds
+
+
+# Page index
+# Pages are keyed by tag, so listing tags alphabetically is a keys-only query in key order:
+# no Page entities are loaded, no composite index is needed, and each page of results costs
+# the same however many pages the wiki has. Tags starting with a prefix are a key range.
+# (Keys are sorted by their UTF-8 bytes, so upper case letters sort before lower case.)
+# The range ends at the prefix followed by the highest code point, so tags continuing with
+# any character (including characters outside the Basic Multilingual Plane) are included.
+INDEX_PAGE_SIZE = 100
+MAX_CHARACTER = u'\U0010ffff'
+
+# The page_index function returns INDEX_PAGE_SIZE tags starting with the prefix (in order,
+# from the urlsafe cursor) and the urlsafe cursor of the next tags (None if there are none).
+@timed('page_index')
+def page_index(prefix = '', cursor = None):
+	cursor = Cursor(urlsafe=cursor) if cursor else None
+	query = Page.query()
+	if prefix:
+		query = query.filter(Page.key >= ndb.Key(Page, prefix),
+							 Page.key < ndb.Key(Page, prefix + MAX_CHARACTER))
+	keys, cursor, more = query.order(Page.key).fetch_page(INDEX_PAGE_SIZE, start_cursor=cursor,
+														  keys_only=True)
+	return [key.id() for key in keys], cursor.urlsafe() if more else None
+
+
+# Page cache
+# The title and content displayed for a wiki page are stored in memcache so the most hit
+# route (/wiki/<page_tag>) does not query the datastore on every request.
+#   -- the newest content is stored at '<PAGE_CACHE_VERSION>|<tag>'
+#   -- ?v= views are stored at '<PAGE_CACHE_VERSION>|<tag>|v<revision id>'
+# PAGE_CACHE_VERSION changes whenever the cached dictionary changes shape, so instances running
+# different versions of the app (during a deploy) never read each other's entries.
+# The edit handler rewrites the newest content when a new Content entity is saved.
+# Revisions never change, so ?v= views never need to be invalidated.
+# Entries read from the datastore on a miss are only added (a request that read the page
+# before a save cannot overwrite the saved content), and saves replace the newest content with
+# compare-and-set only if their revision is newer. Newest content entries also expire after
+# PAGE_CACHE_TTL seconds, so an entry a failed write-through left behind is not kept forever.
+PAGE_CACHE_TTL = 60 * 60
+PAGE_CACHE_VERSION = 'page2'
+
+# The page_cache_key function returns the memcache key for a page (and revision)
+def page_cache_key(tag, version = None):
+	if version:
+		return '%s|%s|v%s' % (PAGE_CACHE_VERSION, tag, version)
+	return '%s|%s' % (PAGE_CACHE_VERSION, tag)
+
+# The page_content function returns a dictionary with the title and content to be displayed
+# for a page (or one of its revisions), or None if the page or revision does not exist.
+# The content is cached along with its rendered HTML (see markup.py), so views never parse it.
+# The dictionary also holds the revision (Page.edits for the newest content) and the time
+# the page was modified (None for revisions), which identify the content for HTTP caching.
+# The datastore is only read on a cache miss.
+@timed('page_content')
+def page_content(tag, version = None, update = False):
+	key = page_cache_key(tag, version)
+	cached = None if update else memcache.get(key)
+	if cached is None:
+		page = Page.by_tag(tag)
+		if not page:
+			return None
+		if version:
+			content = get_revision(page, version)
+			if content is None:
+				return None
+			cached = _page_content(tag, content, version, None)
+			_cache_add(key, cached)
+		elif update:
+			cached = _page_content(tag, get_content(page), page.edits, page.modified)
+			_replace_page_content(key, cached)
+		else:
+			cached = _page_content(tag, get_content(page), page.edits, page.modified)
+			_cache_add(key, cached, PAGE_CACHE_TTL)
+	return cached
+
+# The page_contents function returns {tag: page_content(tag)} for the tags. Cached pages are
+# read with one memcache get_multi, and the others with one datastore get_multi and one
+# memcache get_multi of their HTML (and then cached with one memcache add_multi).
+@timed('page_contents')
+def page_contents(tags):
+	keys = dict((page_cache_key(tag), tag) for tag in tags)
+	cached = memcache.get_multi(keys.keys())
+	contents = dict((keys[key], value) for key, value in cached.iteritems())
+	missing = [tag for tag in tags if tag not in contents]
+	pages = [p for p in ndb.get_multi([ndb.Key(Page, tag) for tag in missing]) if p]
+	texts = [get_content(p) or u'' for p in pages]
+	misses = {}
+	for tag in missing:
+		contents[tag] = None
+	for page, text, html in zip(pages, texts, render_html_multi(texts)):
+		contents[page.tag] = _page_content(page.tag, text, page.edits, page.modified, html)
+		misses[page_cache_key(page.tag)] = contents[page.tag]
+	_cache_add_multi(misses, PAGE_CACHE_TTL)
+	return contents
+
+def _page_content(tag, content, revision, modified, html = None):
+	if html is None:
+		html = render_html(content or u'')
+	return {'title': underscore_to_space(tag),
+			'content': content,
+			'html': html,
+			'revision': revision,
+			'modified': modified}
+
+# The set_page_content function writes the newest content of a saved page through to memcache.
+@timed('set_page_content')
+def set_page_content(page):
+	_replace_page_content(page_cache_key(page.tag),
+						  _page_content(page.tag, page.content, page.edits, page.modified))
+
+# _replace_page_content caches the newest content of a page unless newer content is cached.
+# If the entry keeps changing (concurrent saves) or is too large to cache, it is deleted and
+# read again on the next view.
+def _replace_page_content(key, value):
+	client = memcache.Client()
+	try:
+		for retry in xrange(5):
+			cached = client.gets(key)
+			if cached is None:
+				if client.add(key, value, time=PAGE_CACHE_TTL):
+					return
+			elif cached['revision'] >= value['revision']:
+				return
+			elif client.cas(key, value, time=PAGE_CACHE_TTL):
+				return
+	except ValueError:
+		pass
+	client.delete(key)
+
+# memcache raises ValueError for values over its size limit. Pages near the 1 MB content limit
+# (with their HTML) are not cached; they are read from the datastore on every view.
+def _cache_add(key, value, time = 0):
+	try:
+		return memcache.add(key, value, time=time)
+	except ValueError:
+		return False
+
+def _cache_add_multi(mapping, time = 0):
+	try:
+		memcache.add_multi(mapping, time=time)
+	except ValueError:
+		for key, value in mapping.iteritems():
+			_cache_add(key, value, time)
 
 
 # User entity
 # The User entity represents rows of user accounts
 
-# The users_key function returns the parent key for users.
-# Having a parent key guarantees consistency when querying immediately after creation (?)
+# Users are root entities keyed by username, so looking up a user is a single get (cached in
+# memcache at 'user|<username>'), registering a username is an atomic create-if-absent, and
+# signups do not contend on a shared entity group.
+# Until migrate_users has run, users registered before that are only found under users_key, so
+# lookups and registration also check there (see legacy_user).
+
+# The users_key function returns the parent key users were stored under before they were
+# keyed by username. It is only used to migrate users stored under it.
 def users_key(group = 'default'):
 	return ndb.Key('users', group)
 
+def user_cache_key(username):
+	return 'user|%s' % username
+
+# The legacy_user function returns the first user registered with the username under users_key,
+# or None.
+def legacy_user(username):
+	return User.query(User.username == username, ancestor=users_key()).order(User.joined).get()
+
 class User(ndb.Model):
 	username = ndb.StringProperty(required = True)
 	password = ndb.StringProperty(required = True)
@@ -109,34 +563,80 @@ class User(ndb.Model):
 
 	# NOTE: @classmethods are methods called on classes, not instances of classes
 
-	# The by_id classmethod returns the user object corresponding to the user id (uid)
+	# The by_id classmethod returns the user object corresponding to the user id (uid),
+	# which is the username
 	@classmethod
 	def by_id(cls, uid):
-		return cls.get_by_id(uid, parent=users_key())
+		return cls.by_name(uid)
 
 	# The by_name classmethod returns the user object corresponding to the username
 	@classmethod
+	@timed('User.by_name')
 	def by_name(cls, username):
-		# converted to ancestor query for consistency
-		u = cls.query(cls.username==username, ancestor=users_key()).get()
+		key = user_cache_key(username)
+		u = memcache.get(key)
+		if u is None:
+			u = cls.get_by_id(username) or legacy_user(username)
+			if u:
+				memcache.set(key, u)
 		return u
 
-	# The register classmethod creates a new User object and handles password hashing
+	# The register classmethod creates a new User and handles password hashing. It returns
+	# None if the username is already registered.
 	@classmethod
+	@timed('User.register')
 	def register(cls, username, password, email = None):
 		password = make_pw_hash(username, password)
-		return cls(parent = users_key(),
-					username = username,
-					password = password,
-					email = email)
+		u = _create_user(username, password, email)
+		if u:
+			memcache.set(user_cache_key(username), u)
+		return u
 
 	# The login classmethod signs the user into the website
 	@classmethod
+	@timed('User.login')
 	def login(cls, username, password):
 		u = cls.by_name(username)
 		if u and valid_pw(username, password, u.password):
 			return u
 
+# The _create_user function creates the user in a transaction, so two users registering the
+# same username at the same time cannot both succeed.
+@ndb.transactional(xg = True)
+def _create_user(username, password, email):
+	if User.get_by_id(username) or legacy_user(username):
+		return None
+	u = User(id=username, username=username, password=password, email=email)
+	u.put()
+	return u
+
+# The migrate_users function moves User entities stored under users_key to root entities keyed
+# by username. If a username was registered more than once, the first registration is kept,
+# whether it is stored under users_key or as a root entity.
+def migrate_users(cursor = None, batch = 50):
+	cursor = Cursor(urlsafe=cursor) if cursor else None
+	users, cursor, more = User.query(ancestor=users_key()).order(User.joined).fetch_page(
+		batch, start_cursor=cursor)
+	for old in users:
+		_migrate_user(old)
+	return cursor.urlsafe() if more else None
+
+def _migrate_user(old):
+	_move_user(old)
+	memcache.delete(user_cache_key(old.username))
+
+@ndb.transactional(xg = True)
+def _move_user(old):
+	u = User.get_by_id(old.username)
+	if not u or old.joined < u.joined:
+		User(id=old.username, username=old.username, password=old.password,
+			 email=old.email, joined=old.joined).put()
+	old.key.delete()
+
+
+# MIGRATIONS lists the migrations run (in order) by the /_admin/migrate route
+MIGRATIONS = [migrate_pages, migrate_contents, migrate_users]
+
 
 # Post entity
 # The Post entity represents rows of blog posts (sometimes called entries)
@@ -161,42 +661,113 @@ class Post(ndb.Model):
 	         "modified": self.modified.strftime(time_fmt)}
 		return d
 
-# The top_entries function returns the entries to be displayed on the homepage
-# This function uses memcache to ensure the query is run only when a new entry is added to the
-# datastore.
-# Improvements:
-#	(1) Add newly added entry to memcache without calling a query (imporves performance)
-def top_entries(update = False):
-	key = 'top'
-	entries = memcache.get(key)
-	if entries is None or update:
-		# print 'DB Query' when the query is run (for debugging)
-		print 'DB Query'
-
-		#database query for posts
-		entries = Post.query(ancestor=blog_key()).order(-Post.created).fetch(10)
+	# Posts are written through to the post cache whenever they are created or updated, and
+	# removed from it when they are deleted.
+	def _post_put_hook(self, future):
+		if not future.get_exception():
+			cache_post(self)
 
-		#db is not queried until something is ran on entries. Make a list out of the
-		#query to force the query to run. This prevents potentially running the query
-		#multiple times in later code
-		entries = list(entries)
+	@classmethod
+	def _post_delete_hook(cls, key, future):
+		if not future.get_exception():
+			uncache_post(key)
+
+
+# Post cache
+# Blog posts are cached in memcache with keys in the 'post|' namespace:
+#   -- 'post|top' the 10 newest posts (top_entries)
+#   -- 'post|<id>' a post (get_entry). Ids without a post cache POST_MISSING for
+#      POST_MISSING_TTL seconds.
+#   -- 'post|top|time' and 'post|<id>|time' when the value was read from the datastore
+#      (for display on the webpage)
+# Creating and updating posts writes them through to the cache (see Post._post_put_hook),
+# so the datastore is only read when a value has been evicted. When a value is missing,
+# the first request takes a lease ('<key>|lease') and reads the datastore; concurrent
+# requests wait for it to fill the cache instead of all reading the datastore.
+# The lease holder only adds what it read, so it never overwrites a post written through while
+# it was reading. A post saved while the top entries are not cached bumps '<key>|generation';
+# if the generation changed while the lease holder was reading, the entries it read may miss
+# the post, so it deletes them again.
+POST_MISSING = 'post|missing'
+POST_MISSING_TTL = 60
+POST_LEASE_TTL = 5
+POST_LEASE_WAIT = 0.05
+POST_LEASE_TRIES = 20
+TOP_ENTRIES = 10
+
+def post_cache_key(entry_id):
+	return 'post|%s' % entry_id
+
+# The _leased_get function returns the value cached at key. On a miss, load is called (by one
+# request at a time) to read the value from the datastore and cache it.
+def _leased_get(key, load, update = False):
+	value = None if update else memcache.get(key)
+	tries = 0
+	while value is None:
+		if update or memcache.add(key + '|lease', 1, time=POST_LEASE_TTL):
+			try:
+				generation = memcache.get(key + '|generation')
+				value = load()
+				cached = POST_MISSING if value is None else value
+				ttl = POST_MISSING_TTL if value is None else 0
+				if update:
+					memcache.set(key, cached, time=ttl)
+				else:
+					memcache.add(key, cached, time=ttl)
+				if memcache.get(key + '|generation') != generation:
+					memcache.delete(key)
+				# "time" is stored for displaying the latest query on the webpage
+				memcache.set(key + '|time', datetime.now())
+			finally:
+				memcache.delete(key + '|lease')
+			return value
+		tries += 1
+		if tries > POST_LEASE_TRIES:
+			# the lease holder did not fill the cache in time
+			return load()
+		time.sleep(POST_LEASE_WAIT)
+		value = memcache.get(key)
+	return None if value == POST_MISSING else value
 
-		memcache.set(key, entries)
+# The top_entries function returns the entries to be displayed on the homepage
+# The query is only run when the entries are not in memcache (new entries are added to the
+# cached entries when they are saved).
+@timed('top_entries')
+def top_entries(update = False):
+	return _leased_get(post_cache_key('top'), _query_top_entries, update)
 
-		# "time" is stored for displaying the latest query on the webpage
-		memcache.set("time", datetime.now())
-	return entries
+def _query_top_entries():
+	return Post.query(ancestor=blog_key()).order(-Post.created).fetch(TOP_ENTRIES)
 
-# The get_entry function returns the requested entry
-# This function stores the entries in memcache when they are created
+# The get_entry function returns the requested entry (None if there is no such entry)
+@timed('get_entry')
 def get_entry(entry_id):
-	key = '%s' % entry_id
-	entry = memcache.get(key)
-	if entry is None:
-		#database query for post with entry_id
-		entry = Post.get_by_id(int(entry_id), parent=blog_key())
-		memcache.set(key, entry)
-
-		# A "time" key is created for each entry for display on webpage
-		memcache.set('time|%s' % entry_id, datetime.now())
-	return entry
\ No newline at end of file
+	entry_id = int(entry_id)
+	if entry_id < 1:
+		return None
+	return _leased_get(post_cache_key(entry_id),
+					   lambda: Post.get_by_id(entry_id, parent=blog_key()))
+
+# The cache_post function writes a saved post through to the cache: the post is cached and
+# the cached top entries are updated (compare-and-set) without running the query.
+def cache_post(post):
+	memcache.set(post_cache_key(post.key.id()), post)
+	client = memcache.Client()
+	key = post_cache_key('top')
+	for retry in xrange(5):
+		entries = client.gets(key)
+		if entries is None:
+			# the query is run the next time the entries are read (a query that is already
+			# running may have missed the post, see _leased_get)
+			client.incr(key + '|generation', initial_value=0)
+			return
+		entries = [e for e in entries if e.key != post.key] + [post]
+		entries.sort(key=lambda e: e.created, reverse=True)
+		if client.cas(key, entries[:TOP_ENTRIES]):
+			return
+	client.delete(key)
+
+# The uncache_post function removes a deleted post from the cache. The top entries are read
+# from the datastore again, since the entry that replaces the deleted post is not cached.
+def uncache_post(key):
+	memcache.delete_multi([post_cache_key(key.id()), post_cache_key('top')])
@@ -0,0 +1,85 @@
+# entities_test.py
+# This .py file checks that page revisions are rebuilt from their snapshots and deltas (see
+# Content), including after pages stored under wiki_key are migrated and merged, and that users
+# stored under users_key can log in and keep their username before and after they are migrated.
+# It runs against the App Engine testbed and is not deployed (see skip_files in app.yaml).
+#
+# Usage:
+#   python entities_test.py --sdk ~/google-cloud-sdk/platform/google_appengine
+
+import argparse
+import os
+import sys
+import unittest
+
+
+def texts(name, n):
+	return [u'%s revision %d\nline two\n' % (name, i) + u'shared line\n' * i for i in xrange(n)]
+
+
+class RevisionTest(unittest.TestCase):
+	def setUp(self):
+		from google.appengine.ext import ndb
+		ndb.get_context().clear_cache()
+
+	def assertRevisions(self, tag, expected):
+		from entities import Page, Content, content_texts, get_revision
+		page = Page.by_tag(tag)
+		contents = Content.query(ancestor=page.key).order(Content.created).fetch()
+		self.assertEqual(content_texts(contents), expected)
+		for c, text in zip(contents, expected):
+			self.assertEqual(get_revision(page, c.key.id()), text)
+
+	def test_snapshots_and_deltas(self):
+		from entities import Page, SNAPSHOT_INTERVAL
+		saved = texts('page', SNAPSHOT_INTERVAL * 2 + 3)
+		for text in saved:
+			Page.save('Deltas', text, 'author')
+		self.assertRevisions('Deltas', saved)
+
+	def test_merged_page(self):
+		from entities import Page, Content, wiki_key, migrate_pages
+		legacy = texts('legacy', 3)
+		old = Page(parent=wiki_key(), tag='Merged', owner='author', edits=len(legacy))
+		old.put()
+		for text in legacy:
+			Content(parent=old.key, content=text, author='author').put()
+		# the page was saved again (as a root entity) before the migration ran
+		first = texts('root', 1)
+		Page.save('Merged', first[0], 'author')
+		while migrate_pages():
+			pass
+		later = texts('later', 5)
+		for text in later:
+			Page.save('Merged', text, 'author')
+		self.assertRevisions('Merged', legacy + first + later)
+
+
+class UserTest(unittest.TestCase):
+	def setUp(self):
+		from google.appengine.ext import ndb
+		ndb.get_context().clear_cache()
+
+	def test_legacy_user(self):
+		from entities import User, users_key, make_pw_hash, migrate_users
+		User(parent=users_key(), username='legacy', password=make_pw_hash('legacy', 'secret'),
+			 email='legacy@example.com').put()
+		self.assertTrue(User.login('legacy', 'secret'))
+		self.assertIsNone(User.register('legacy', 'other'))
+		while migrate_users():
+			pass
+		self.assertEqual(User.login('legacy', 'secret').email, 'legacy@example.com')
+		self.assertIsNone(User.login('legacy', 'other'))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check the page revisions.')
+	parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+						help='path to the App Engine Python SDK (or set APPENGINE_SDK)')
+	options, argv = parser.parse_known_args()
+	import benchmark
+	tb = benchmark.setup(options.sdk)
+	try:
+		unittest.main(argv=sys.argv[:1] + argv)
+	finally:
+		tb.deactivate()
@@ -1,10 +1,21 @@
 """`main` is the top level module for your Flask application."""
 
+import hashlib
+import json
+import os
+import string
+import uuid
 # Import the Flask Framework
-from flask import Flask, render_template, redirect, url_for, request, session, flash
+from flask import Flask, render_template, redirect, url_for, request, session, flash, abort, jsonify, g
+from flask import stream_with_context
 from flask.views import View
+from google.appengine.api import datastore_errors, memcache, taskqueue
 from entities import *
+from search import index_page, search_pages, migrate_search_index
 from utils import *
+# transfer.py is only used by admin routes and tasks, so it is imported by them
+# (and by the warmup request) rather than on every instance start.
+import stats
 app = Flask(__name__)
 # secret key for sessions. This needs to be a random file and kept safe
 app.secret_key = 'secret'
@@ -12,22 +23,125 @@ app.secret_key = 'secret'
 # the App Engine WSGI application server.
 
 
+# Request stats
+# Every request is timed and its datastore/memcache RPCs are counted by route
+# (see stats.py). Set STATS_HEADER to add the stats of each request to its
+# response in the X-Wiki-Stats header.
+app.config['STATS_HEADER'] = False
+stats.install()
+
+@app.before_request
+def start_stats():
+    g.stats = stats.Timer()
+
+@app.after_request
+def record_stats(response):
+    timer = getattr(g, 'stats', None)
+    if timer:
+        sample = timer.stop()
+        rule = request.url_rule
+        stats.record(rule.rule if rule else '<unmatched>', sample)
+        if app.config['STATS_HEADER']:
+            response.headers['X-Wiki-Stats'] = stats.header(sample)
+    return response
+
+
+# Static assets
+# asset_url returns the URL of a bundle built by assets.py (i.e. site.css).
+# Bundle file names include a hash of their content and are cached by browsers
+# for a year (see app.yaml). The names are read from assets.json on first use.
+# Rendered pages link to the bundles, so their ETags include the bundle names
+# (see conditional_response) and change when a bundle does.
+ASSETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets.json')
+_assets = {}
+
+def assets():
+    if not _assets:
+        with open(ASSETS) as f:
+            _assets.update(json.load(f))
+    return _assets
+
+def asset_url(name):
+    return url_for('static', filename=assets()[name])
+
+def assets_etag():
+    return ','.join(sorted(assets().itervalues()))
+
+@app.context_processor
+def asset_helpers():
+    return {'asset_url': asset_url}
+
+
+# conditional_response returns the response for a GET request of a view whose
+# output only changes when etag changes, so browsers and the App Engine edge
+# cache can reuse it:
+#   -- the response has ETag, Last-Modified and Cache-Control (max_age seconds)
+#      headers. Pages shown to a logged in user include their username, so the
+#      username is part of the ETag and the response is cached privately with
+#      max-age 0: the browser revalidates it on every request, so an editor
+#      sees their own save at once. Views that depend on the user also send
+#      Vary: Cookie, so a copy cached for a logged out user is never shown to
+#      a logged in one (by the browser or the edge cache).
+#   -- if the request has a matching If-None-Match (or If-Modified-Since)
+#      header, a 304 response is returned and render is never called.
+#   -- pages with flashed messages are never cached.
+#   -- HTML views (no mimetype) are revalidated when the asset bundles change.
+# render is a function that returns the rendered view. Set personal to False
+# for views (like the JSON API) that are the same for every user.
+def conditional_response(render, etag, last_modified=None, max_age=0,
+                         personal=True, mimetype=None):
+    if personal and '_flashes' in session:
+        return render()
+    username = session.get('username') if personal else None
+    if username:
+        etag = '%s|%s' % (etag, username)
+    if not mimetype:
+        etag = '%s|%s' % (etag, assets_etag())
+    etag = hashlib.sha1(etag.encode('utf-8')).hexdigest()
+    response = app.response_class(mimetype=mimetype)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    if username:
+        response.cache_control.max_age = 0
+        response.cache_control.private = True
+    else:
+        response.cache_control.max_age = max_age
+        response.cache_control.public = True
+    if personal:
+        response.vary.add('Cookie')
+    if request.if_none_match:
+        not_modified = etag in request.if_none_match
+    else:
+        not_modified = (last_modified and request.if_modified_since and
+                        request.if_modified_since >= last_modified.replace(microsecond=0))
+    if not_modified:
+        response.status_code = 304
+    else:
+        response.data = render()
+    return response
+
+# Seconds responses can be cached. Revisions never change; the newest content
+# of a page is cached for a short time so edge caches can absorb traffic spikes.
+REVISION_MAX_AGE = 365 * 24 * 60 * 60
+PAGE_MAX_AGE = 60
+
+
 # home renders the homepage of the wiki
 # Improvements:
 #   (1) Show the most recently updated/created pages in a different way. Right now
 #       the pages are represented by their tags which are ugly (i.e. Houston_Texas).
 #       May want to write a parsing function to format the text that is displayed.
-#   (2) Add a wikipage search or an alphabetical index?
-#   (3) Add an info webpage the describes how to use the wiki
+#   (2) Add an info webpage the describes how to use the wiki
 @app.route('/')
 @app.route('/wiki')
 @app.route('/home')
 def home(newe_pages=None, update_pages=None):
-    new_pages = newest_pages()
-    update_pages = newest_page_updates()
+    # both feeds are read with a single memcache get
+    feeds = page_feeds()
     return render_template('home.html',
-                            newest_pages=new_pages,
-                            updated_pages=update_pages)
+                            newest_pages=feeds['newest'],
+                            updated_pages=feeds['updated'])
 
 
 # wikipage renders a page in the wiki
@@ -36,22 +150,29 @@ def home(newe_pages=None, update_pages=None):
 #       Reoragnize the code to prevent the retyping.
 @app.route('/wiki/<page_tag>')
 def wikipage(page_tag):
-    # query for Page entity corresponding to the page_tag
-    page = Page.by_tag(page_tag)
     # get version parameter value (/..?v=#)
-    # The version number is sent when redirecting from a history page
-    version = request.args.get('v')
+    # The version is the revision id sent when redirecting from a history page
+    version = request.args.get('v', 0, type=int)
+    # revision ids start at 1
+    if version < 0:
+        abort(404)
+    # title and content for the page_tag are served from memcache (the
+    # datastore is only read on a cache miss)
+    page = page_content(page_tag, version)
     # if there is a matching page in the database, return the page
     if page:
-        title = underscore_to_space(page_tag)
-        if version and int(version) > 0:
-            content = get_history(page)[int(version)].content
-        else:
-            content = get_content(page).content
-        return render_template('wikipage.html',
-                                content=content,
-                                page_tag=page_tag,
-                                title=title)
+        render = lambda: render_template('wikipage.html',
+                                          html=page['html'],
+                                          page_tag=page_tag,
+                                          title=page['title'])
+        etag = '%s-%s' % (page_tag, page['revision'])
+        if version:
+            return conditional_response(render, etag, max_age=REVISION_MAX_AGE)
+        return conditional_response(render, etag, page['modified'],
+                                    max_age=PAGE_MAX_AGE)
+    # there is no page revision with the requested version
+    elif version:
+        abort(404)
     # if the there is not a matching page in the database, go to edit page
     else:
         flash('The requested page does not exist.')
@@ -68,35 +189,39 @@ def wikipage(page_tag):
 @app.route('/edit/<page_tag>', methods=['GET', 'POST'])
 def edit(page_tag, content=None):
     if session.get('username'):
-        p = Page.by_tag(page_tag)
         if request.method == 'POST':
             user_content = request.form['content']
-            # if there is no matching page, create the page.
+            # save the content, creating the page if there is no matching page.
             # This code is in the post method so pages only get created if the
             # user has created content for the page.
-            if not p:
-                p = Page(tag=page_tag, owner=session['username'],
-                         edits = 0, parent=wiki_key())
-                p.put()
-            # create content entity with parent p
-            c = Content(content=user_content, author=session['username'],
-                        parent=p.key)
-            c.put()
-            # update the counter for number of saved edits for a page.
-            # This is not very elegant, but it was a way for me to force the
-            # modified date property in the Page instance to udpate when a new
-            # content instance is created.
-            p.edits += 1
-            p.put()
+            try:
+                p, created = Page.save(page_tag, user_content,
+                                       session['username'])
+            except datastore_errors.TransactionFailedError:
+                # another user saved the page at the same time. Show the
+                # user's content again so they can resubmit it.
+                flash('The page was being saved by someone else. '
+                      'Please save again.')
+                return render_template('editpage.html', page_tag=page_tag,
+                                        content=user_content,
+                                        title=underscore_to_space(page_tag)), 409
+            # list the page on the home page feeds
+            push_page_feeds(p, created)
+            # write the new content through to the page cache (the search
+            # index task was queued by the save)
+            set_page_content(p)
             # render the page with the new content
             return redirect(url_for('wikipage', page_tag=page_tag))
         # if a user is logged in, allow the page to be edited
-        version = request.args.get('v')
-        if p:
-            if version and int(version) > 0:
-                content = get_history(p)[int(version)].content
-            else:
-                content = get_content(p).content
+        version = request.args.get('v', 0, type=int)
+        if version < 0:
+            abort(404)
+        p = Page.by_tag(page_tag)
+        # the newest content is stored on the page itself
+        if p and version:
+            content = get_revision(p, version)
+        elif p:
+            content = get_content(p)
         if not content:
             content = ('The requested page does not exist.\n'
                        'To create the page, enter text in this text area '
@@ -111,9 +236,8 @@ def edit(page_tag, content=None):
 
 
 # histroy renders the content history for a page in the wiki
-# Improvements:
-#   (1) Improve how the history table is displayed. Limit the number of characters
-#       shown for the content field?
+# The history is shown HISTORY_PAGE_SIZE revisions at a time. The cursor
+# parameter (/..?cursor=) is the position of the next (older) set of revisions.
 @app.route('/history/<page_tag>')
 def history(page_tag, history=None):
         p = Page.by_tag(page_tag)
@@ -122,11 +246,232 @@ def history(page_tag, history=None):
                   'no history is available.')
             return redirect(url_for('edit', page_tag=page_tag))
         else:
-            history = get_history(p)
-            title = underscore_to_space(page_tag)
-            return render_template('history.html', page_tag=page_tag,
-                                    history=history,
-                                    title=title)
+            # the history only changes when the page is saved
+            cursor = request.args.get('cursor')
+            def render():
+                history, next_cursor = get_history(p, cursor)
+                title = underscore_to_space(page_tag)
+                return render_template('history.html', page_tag=page_tag,
+                                        history=history,
+                                        cursor=next_cursor,
+                                        title=title)
+            etag = 'history-%s-%s-%s' % (page_tag, p.edits, cursor or '')
+            return conditional_response(render, etag, p.modified)
+
+
+# diff renders the changes between two revisions of a page
+# (/diff/<page_tag>?from=&to=). Without to, the newest revision is shown, and
+# without from, the revision is compared with the one saved before it. Only
+# diffs of two explicit revisions never change and are cached like a ?v= view;
+# the others change when the page is saved.
+@app.route('/diff/<page_tag>')
+def diff(page_tag):
+    p = Page.by_tag(page_tag)
+    if not p:
+        abort(404)
+    new = request.args.get('to', type=int)
+    old = request.args.get('from', type=int)
+    explicit = new is not None and old is not None
+    if new is None:
+        new = previous_revision(p)
+    if new is not None and old is None:
+        old = previous_revision(p, new)
+    # revision ids start at 1
+    if old is None or new is None or old < 1 or new < 1:
+        abort(404)
+    def render():
+        d = revision_diff(p, old, new)
+        if d is None:
+            abort(404)
+        return render_template('diff.html', page_tag=page_tag, old=old, new=new,
+                                diff=d, title=underscore_to_space(page_tag))
+    etag = 'diff-%s-%s-%s' % (page_tag, old, new)
+    if explicit:
+        return conditional_response(render, etag, max_age=REVISION_MAX_AGE)
+    return conditional_response(render, etag, p.modified, max_age=PAGE_MAX_AGE)
+
+
+# index renders an alphabetical index of the pages in the wiki. The prefix
+# parameter (/index?prefix=Houston_) lists the pages whose tag starts with the
+# prefix, and the cursor parameter is the position of the next set of pages.
+@app.route('/index')
+def index():
+    prefix = request.args.get('prefix', '')
+    tags, cursor = page_index(prefix, request.args.get('cursor'))
+    return render_template('index.html', prefix=prefix, cursor=cursor,
+                           pages=[(tag, underscore_to_space(tag)) for tag in tags],
+                           letters=string.ascii_uppercase)
+
+
+# search renders the pages matching the search query (/search?q=)
+@app.route('/search')
+def search(results=None):
+    query = request.args.get('q', '')
+    if query:
+        results = search_pages(query)
+    return render_template('search.html', query=query, results=results)
+
+
+# index_task updates the search index for a page after it is saved. It is run
+# from the task queue (queued by Page.save); /_tasks/* routes can only be
+# reached by the task queue and app admins (see app.yaml).
+@app.route(INDEX_TASK_URL, methods=['POST'])
+def index_task():
+    index_page(request.form['tag'])
+    return ''
+
+
+# warmup prepares a new instance before App Engine sends it user requests
+# (inbound_services: warmup in app.yaml), so the first user request takes
+# about as long as any other:
+#   -- every template is compiled (Jinja compiles templates on first use) and
+#      the asset bundle names are read
+#   -- the modules with ndb models that are not imported at startup are imported
+#   -- the home page feeds and the pages they list are read into memcache (and
+#      rendered) if they are not cached already
+@app.route('/_ah/warmup')
+def warmup():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    assets()
+    import transfer
+    feeds = page_feeds()
+    tags = set(p['tag'] for name in FEED_ORDERS for p in feeds[name])
+    page_contents(list(tags))
+    return ''
+
+
+# stats_summary returns the percentiles of the request and helper stats
+# collected by this instance as JSON (?reset=1 clears them). Only app admins
+# can reach /_stats (see app.yaml).
+@app.route('/_stats')
+def stats_summary():
+    summary = stats.summary()
+    if request.args.get('reset'):
+        stats.reset()
+    return jsonify(summary)
+
+
+# migrate moves datastore entities created before a data model change to the
+# current model. Only app admins can reach /_admin/* routes (see app.yaml).
+# Each request migrates one batch and redirects to the next batch (and then to
+# the next migration step) until the migration is complete.
+@app.route('/_admin/migrate')
+@app.route('/_admin/migrate/<int:step>')
+def migrate(step=0):
+    migrations = MIGRATIONS + [migrate_search_index]
+    cursor = migrations[step](request.args.get('cursor'))
+    if cursor:
+        return redirect(url_for('migrate', step=step, cursor=cursor))
+    if step + 1 < len(migrations):
+        return redirect(url_for('migrate', step=step + 1))
+    return 'Migration complete.'
+
+
+# JSON API
+# The api routes return pages as JSON for integrations:
+#   -- /api/pages/<page_tag> the newest content of a page
+#   -- /api/pages/<page_tag>/revisions/<revision> a revision of a page
+#   -- /api/pages?tags=<tag>,<tag>,... the newest content of up to
+#      API_BATCH_SIZE pages (null for tags without a page), read with one
+#      memcache get_multi and one datastore get_multi
+# Responses support conditional requests and are cached like the wiki pages.
+API_BATCH_SIZE = 100
+
+def page_json(page_tag, page):
+    return {'tag': page_tag,
+            'title': page['title'],
+            'revision': page['revision'],
+            'modified': page['modified'] and page['modified'].isoformat(),
+            'content': page['content'],
+            'html': page['html']}
+
+def json_response(data, etag, last_modified=None, max_age=0):
+    return conditional_response(lambda: json.dumps(data, separators=(',', ':')),
+                                'api|' + etag, last_modified, max_age,
+                                personal=False, mimetype='application/json')
+
+
+@app.route('/api/pages/<page_tag>')
+@app.route('/api/pages/<page_tag>/revisions/<int:version>')
+def api_page(page_tag, version=None):
+    if version is not None and version < 1:
+        abort(404)
+    page = page_content(page_tag, version)
+    if not page:
+        abort(404)
+    etag = '%s-%s' % (page_tag, page['revision'])
+    if version is not None:
+        return json_response(page_json(page_tag, page), etag,
+                             max_age=REVISION_MAX_AGE)
+    return json_response(page_json(page_tag, page), etag, page['modified'],
+                         max_age=PAGE_MAX_AGE)
+
+
+@app.route('/api/pages')
+def api_pages():
+    tags = [t for t in request.args.get('tags', '').split(',') if t]
+    if not tags or len(tags) > API_BATCH_SIZE:
+        abort(400)
+    pages = page_contents(tags)
+    data = {'pages': dict((tag, page and page_json(tag, page))
+                          for tag, page in pages.iteritems())}
+    etag = ','.join('%s-%s' % (tag, page and page['revision'])
+                    for tag, page in sorted(pages.iteritems()))
+    modified = [page['modified'] for page in pages.itervalues() if page]
+    return json_response(data, etag, max(modified) if modified else None,
+                         max_age=PAGE_MAX_AGE)
+
+
+# export_pages streams every page and its revisions as JSON Lines (see
+# transfer.py). A response holds part of the export; its last line gives the
+# position (/_admin/export?position=) the export continues from.
+@app.route('/_admin/export')
+def export_pages():
+    from transfer import export_lines
+    lines = export_lines(request.args.get('position'))
+    return app.response_class(stream_with_context(lines),
+                              mimetype='application/x-ndjson')
+
+
+# import_pages stores an export (JSON Lines request body) and imports it in
+# chunks from the task queue, one chunk after the other.
+@app.route('/_admin/import', methods=['POST'])
+def import_pages():
+    from transfer import store_import
+    job = uuid.uuid4().hex
+    chunks = store_import(job, request.stream)
+    if chunks:
+        queue_import_task(job, 0)
+    return jsonify(job=job, chunks=chunks)
+
+
+# import_task imports one chunk of an import and queues the next chunk. Tasks
+# are named by job and chunk, so a retried task does not queue a chunk twice.
+@app.route('/_tasks/import', methods=['POST'])
+def import_task():
+    from transfer import import_chunk, delete_chunk
+    job, n = request.form['job'], int(request.form['chunk'])
+    tags = import_chunk(job, n)
+    if tags is None:
+        return ''
+    # imported pages are read from the datastore again and are indexed
+    memcache.delete_multi([page_cache_key(tag) for tag in tags] + [FEEDS_KEY])
+    tasks = [taskqueue.Task(url=url_for('index_task'), params={'tag': tag})
+             for tag in tags]
+    for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+    queue_import_task(job, n + 1)
+    delete_chunk(job, n)
+    return ''
+
+
+def queue_import_task(job, n):
+    try:
+        taskqueue.add(url=url_for('import_task'), name='import-%s-%d' % (job, n),
+                      params={'job': job, 'chunk': n})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -230,17 +575,15 @@ class Register(SignUp):
         return 'welcome'
 
     def done(self, *a, **kw):
-        # query User entities for the submitted username
-        u = User.by_name(self.username)
+        # call register classmethod on User to create a new User in the db.
+        # register returns None if the username is already taken
+        u = User.register(self.username, self.password, self.email)
         # throw an error message if the username is already taken
-        if u:
+        if not u:
             msg = 'user is already registered'
             return self.render_template(username_error=msg, **kw)
-        # register user if username is not taken
+        # the user is registered if the username is not taken
         else:
-            # call register classmethod on User to create a new User in the db
-            u = User.register(self.username, self.password, self.email)
-            u.put()
             # automatically log the user in and redirect to the welcome page
             # redirect requires code 307 to redirect as POST
             return redirect(url_for('login'), code=307)
@@ -248,6 +591,21 @@ class Register(SignUp):
 app.add_url_rule('/signup', view_func=Register.as_view('signup'))
 
 
+# blog_json returns the top blog entries as JSON
+@app.route('/blog/.json')
+def blog_json():
+    return jsonify(entries=[e.as_dict() for e in top_entries()])
+
+
+# entry_json returns a blog entry as JSON
+@app.route('/blog/<int:entry_id>.json')
+def entry_json(entry_id):
+    entry = get_entry(entry_id)
+    if not entry:
+        abort(404)
+    return jsonify(entry.as_dict())
+
+
 @app.route('/welcome')
 def welcome(username=''):
     if 'username' in session:
@@ -0,0 +1,181 @@
+# markup.py
+# This .py file contains the wiki markup renderer. Page content is wiki markup, rendered to
+# HTML on the server:
+#   -- = Heading = to ====== Heading ====== for headings (h1 to h6)
+#   -- lines starting with * (bulleted) or # (numbered) are list items; ** and ## nest
+#   -- ---- is a horizontal rule
+#   -- lines separated by a blank line are paragraphs
+#   -- '''bold''', ''italic'' and '''''both''''' (tags still open are closed at the end of the
+#      line, and overlapping ones are closed and reopened so the HTML is well nested)
+#   -- [[Page_Tag]] and [[Page_Tag|label]] link to wiki pages, [http://... label] to other sites
+# Everything else is text: it is HTML escaped, so the only tags in the rendered page are the
+# ones the renderer writes and authors cannot add scripts, styles or attributes.
+# Rendered HTML is stored in memcache by content hash ('html|<version>|<sha1 of the content>'),
+# so a content is only parsed once, however many pages, revisions and views show it. Change
+# HTML_CACHE_VERSION whenever the HTML the renderer writes changes.
+# Improvements:
+#	(1) Tables and images.
+#	(2) Show links to pages that do not exist yet differently.
+
+import cgi
+import hashlib
+import re
+from flask import url_for
+from google.appengine.api import memcache
+from utils import underscore_to_space
+from stats import timed
+
+# Patterns never have two quantifiers that can match the same characters next to each other
+# (like \s*(.+?)\s*), so matching a line takes linear time however long the line is.
+HEADING_RE = re.compile(r'^(={1,6})(.+?)\1\s*$')
+LIST_RE = re.compile(r'^([*#]+)(.*)$')
+RULE_RE = re.compile(r'^-{4,}\s*$')
+LINK_RE = re.compile(r'\[\[([^\[\]|/]+)(?:\|([^\[\]]+))?\]\]'
+					 r'|\[((?:https?://|mailto:)[^\s\[\]]+)(?:\s([^\[\]]+))?\]')
+QUOTES_RE = re.compile(r"''+")
+LIST_TAGS = {'*': 'ul', '#': 'ol'}
+HTML_CACHE_VERSION = 'html2'
+
+
+def escape(s):
+	return cgi.escape(s, True)
+
+# Link labels and URLs also have their quotes escaped so they are never taken for ''italic''
+def _escape_link(s):
+	return escape(s).replace("'", '&#39;')
+
+def _link(match):
+	tag, label, url, url_label = match.groups()
+	if tag:
+		tag = tag.strip().replace(' ', '_')
+		return '<a href="%s">%s</a>' % (_escape_link(url_for('wikipage', page_tag=tag)),
+										_escape_link(label or underscore_to_space(tag)))
+	url_label = url_label and url_label.strip()
+	return '<a href="%s" rel="nofollow">%s</a>' % (_escape_link(url),
+												   _escape_link(url_label or url))
+
+# The inline function renders the text of a line: links, then bold and italic text.
+def inline(text):
+	html, start = [], 0
+	for match in LINK_RE.finditer(text):
+		html.append(escape(text[start:match.start()]))
+		html.append(_link(match))
+		start = match.end()
+	html.append(escape(text[start:]))
+	return _emphasis(''.join(html))
+
+# The _emphasis function replaces runs of quotes with <b> and <i> tags: '' toggles italic,
+# ''' bold, '''' is a quote and bold, and ''''' (or more, the extra quotes are text) both.
+def _emphasis(html):
+	out, start, stack = [], 0, []
+
+	def toggle(tag):
+		if tag not in stack:
+			stack.append(tag)
+			out.append('<%s>' % tag)
+			return
+		# close the tags opened after this one, then reopen them
+		reopen = stack[stack.index(tag) + 1:]
+		for t in reversed(reopen):
+			out.append('</%s>' % t)
+		out.append('</%s>' % tag)
+		stack.remove(tag)
+		for t in reopen:
+			out.append('<%s>' % t)
+
+	for match in QUOTES_RE.finditer(html):
+		out.append(html[start:match.start()])
+		start = match.end()
+		n = len(match.group())
+		if n == 2:
+			toggle('i')
+		elif n == 3:
+			toggle('b')
+		elif n == 4:
+			out.append("'")
+			toggle('b')
+		else:
+			out.append("'" * (n - 5))
+			# close the open tags innermost first, then open the others
+			for tag in list(reversed(stack)) + [t for t in ('b', 'i') if t not in stack]:
+				toggle(tag)
+	out.append(html[start:])
+	for tag in reversed(stack):
+		out.append('</%s>' % tag)
+	return ''.join(out)
+
+
+# The render function returns the HTML of wiki markup
+def render(text):
+	html, paragraph, lists = [], [], []
+
+	def end_paragraph():
+		if paragraph:
+			html.append('<p>%s</p>' % '\n'.join(paragraph))
+			del paragraph[:]
+
+	# set_lists opens and closes lists so that the open lists match the markers of a list item
+	def set_lists(markers):
+		common = 0
+		while common < min(len(lists), len(markers)) and lists[common] == markers[common]:
+			common += 1
+		while len(lists) > common:
+			html.append('</li></%s>' % LIST_TAGS[lists.pop()])
+		if lists and len(lists) == len(markers):
+			html.append('</li>')
+		while len(lists) < len(markers):
+			lists.append(markers[len(lists)])
+			html.append('<%s>' % LIST_TAGS[lists[-1]])
+
+	for line in text.splitlines():
+		heading = HEADING_RE.match(line)
+		item = LIST_RE.match(line)
+		if heading or item or RULE_RE.match(line) or not line.strip():
+			end_paragraph()
+		if not item:
+			set_lists('')
+		if heading:
+			level = len(heading.group(1))
+			html.append('<h%d>%s</h%d>' % (level, inline(heading.group(2).strip()), level))
+		elif item:
+			set_lists(item.group(1))
+			html.append('<li>%s' % inline(item.group(2).strip()))
+		elif RULE_RE.match(line):
+			html.append('<hr>')
+		elif line.strip():
+			paragraph.append(inline(line))
+	end_paragraph()
+	set_lists('')
+	return '\n'.join(html)
+
+
+def html_cache_key(text):
+	return 'html|%s|%s' % (HTML_CACHE_VERSION, hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+# The render_html function returns the HTML of wiki markup, rendering it only if the same
+# content has not been rendered before.
+@timed('render_html')
+def render_html(text):
+	return render_html_multi([text])[0]
+
+# The render_html_multi function returns the HTML of each of the texts. Cached HTML is read with
+# one memcache get_multi and the HTML rendered for the others is cached with one set_multi.
+@timed('render_html_multi')
+def render_html_multi(texts):
+	keys = [html_cache_key(text) for text in texts]
+	cached = memcache.get_multi(list(set(keys)))
+	rendered = {}
+	for key, text in zip(keys, texts):
+		if key not in cached and key not in rendered:
+			rendered[key] = render(text)
+	if rendered:
+		try:
+			memcache.set_multi(rendered)
+		except ValueError:
+			# the HTML of very large pages can exceed the memcache value size limit
+			for key, html in rendered.iteritems():
+				try:
+					memcache.set(key, html)
+				except ValueError:
+					pass
+	return [cached[key] if key in cached else rendered[key] for key in keys]
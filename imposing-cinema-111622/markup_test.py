@@ -0,0 +1,68 @@
+# markup_test.py
+# This .py file checks that rendering wiki markup takes linear time: pages are rendered while
+# they are saved and viewed, so a line that makes a pattern backtrack would block requests.
+# It is not deployed (see skip_files in app.yaml).
+#
+# Usage:
+#   python markup_test.py --sdk ~/google-cloud-sdk/platform/google_appengine
+
+import argparse
+import os
+import sys
+import time
+import unittest
+
+LINE_LENGTH = 100000
+MAX_SECONDS = 1.0
+
+# lines that took cubic (or quadratic) time with earlier patterns
+LINES = [u'= ' + u' ' * LINE_LENGTH + u'x',
+		 u'== ' + u'\t' * LINE_LENGTH + u' ==x',
+		 u'=' + u' = ' * (LINE_LENGTH / 3),
+		 u'* ' + u' ' * LINE_LENGTH + u'x',
+		 u'[http://example.com' + u' ' * LINE_LENGTH + u'x',
+		 u'[http://example.com ' * (LINE_LENGTH / 20),
+		 u'[[' * (LINE_LENGTH / 2),
+		 u"''" * (LINE_LENGTH / 2) + u"'"]
+
+
+class MarkupTest(unittest.TestCase):
+	def setUp(self):
+		from flask import Flask
+		self.app = Flask(__name__)
+		self.app.add_url_rule('/wiki/<page_tag>', 'wikipage')
+
+	def test_long_lines(self):
+		import markup
+		with self.app.test_request_context():
+			for line in LINES:
+				start = time.time()
+				markup.render(line)
+				self.assertLess(time.time() - start, MAX_SECONDS, repr(line[:20]))
+
+	def test_render(self):
+		import markup
+		with self.app.test_request_context():
+			self.assertEqual(markup.render(u'==  Title  ==\n*  [[Houston_Texas]]\n<b>'),
+							 u'<h2>Title</h2>\n<ul>\n<li><a href="/wiki/Houston_Texas">'
+							 u'Houston Texas</a>\n</li></ul>\n<p>&lt;b&gt;</p>')
+
+	def test_emphasis(self):
+		import markup
+		with self.app.test_request_context():
+			self.assertEqual(markup.render(u"'''''both''''' and '''b ''bi''' i''\n''open"),
+							 u'<p><b><i>both</i></b> and <b>b <i>bi</i></b><i> i</i>\n'
+							 u'<i>open</i></p>')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check the wiki markup renderer.')
+	parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+						help='path to the App Engine Python SDK (or set APPENGINE_SDK)')
+	options, argv = parser.parse_known_args()
+	import benchmark
+	tb = benchmark.setup(options.sdk)
+	try:
+		unittest.main(argv=sys.argv[:1] + argv)
+	finally:
+		tb.deactivate()
@@ -0,0 +1,145 @@
+# search.py
+# This .py file contains the wiki page search index and related functions
+# The index is an inverted index stored in the datastore: every token of a page is a
+# SearchPosting (token -> page tag, with the number of times the token appears in the page).
+# Queries are answered from the postings; Content entities are never scanned.
+# Improvements:
+#	(1) Stemming ("pages" does not match "page").
+#	(2) Phrase queries.
+
+import math
+import re
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from entities import Page
+from utils import underscore_to_space
+from stats import timed
+
+
+# SearchDocument entity
+# The SearchDocument entity stores the term frequencies a page was last indexed with, so a
+# save only writes the postings that changed. It is keyed by the page tag and is the parent
+# of the page's postings (each page's index is its own entity group).
+class SearchDocument(ndb.Model):
+	terms = ndb.JsonProperty(compressed = True)
+		# {token: term frequency}
+	length = ndb.IntegerProperty()
+		# number of tokens in the page
+
+# SearchPosting entity
+# The SearchPosting entity represents one token of one page. It is keyed by the token under
+# the page's SearchDocument.
+class SearchPosting(ndb.Model):
+	token = ndb.StringProperty(required = True)
+	tf = ndb.IntegerProperty(required = True)
+		# term frequency: the number of times the token appears in the page
+
+
+# Tokens are lowercase words of at least 2 characters that are not stop words.
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKEN_LENGTH = 100
+STOP_WORDS = frozenset(['an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+						'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was',
+						'with'])
+
+def tokenize(text):
+	return [t for t in TOKEN_RE.findall(text.lower())
+			if 1 < len(t) <= MAX_TOKEN_LENGTH and t not in STOP_WORDS]
+
+def term_frequencies(text):
+	terms = {}
+	for t in tokenize(text):
+		terms[t] = terms.get(t, 0) + 1
+	return terms
+
+def document_key(tag):
+	return ndb.Key(SearchDocument, tag)
+
+
+# The index_page function updates the index for a page to its current content. Only postings
+# whose term frequency changed are written. The page tag is indexed along with the content.
+# Indexing always reads the newest content, so it is safe to run more than once or out of
+# order (the edit handler runs it from the task queue after every save).
+# The page and its index are in different entity groups, so indexing is a cross-group
+# transaction.
+@timed('index_page')
+@ndb.transactional(xg = True)
+def index_page(tag):
+	page = Page.by_tag(tag)
+	parent = document_key(tag)
+	doc = parent.get()
+	terms = {}
+	if page:
+		terms = term_frequencies(underscore_to_space(tag) + '\n' + (page.content or ''))
+	old_terms = doc.terms if doc else {}
+	puts = [SearchPosting(id=t, parent=parent, token=t, tf=n)
+			for t, n in terms.iteritems() if old_terms.get(t) != n]
+	deletes = [ndb.Key(SearchPosting, t, parent=parent)
+			   for t in old_terms if t not in terms]
+	if page:
+		puts.append(SearchDocument(key=parent, terms=terms, length=sum(terms.itervalues())))
+	else:
+		deletes.append(parent)
+	ndb.put_multi(puts)
+	ndb.delete_multi(deletes)
+
+
+# The search_pages function returns the pages best matching the query (at most limit) as
+# dictionaries with the tag, title, score and a snippet of the page content.
+# The postings of every query token are fetched in parallel (at most POSTINGS_LIMIT per
+# token, highest term frequency first). Pages are scored by tf-idf:
+#   score = sum over query tokens of (1 + log(tf)) * log(1 + POSTINGS_LIMIT / df)
+# where df is the number of postings found for the token. Pages matching more query tokens
+# (and rarer tokens) rank first.
+POSTINGS_LIMIT = 200
+MAX_QUERY_TOKENS = 10
+
+@timed('search_pages')
+def search_pages(query, limit = 10):
+	tokens = list(set(tokenize(query)))[:MAX_QUERY_TOKENS]
+	futures = [SearchPosting.query(SearchPosting.token == t)
+				.order(-SearchPosting.tf).fetch_async(POSTINGS_LIMIT) for t in tokens]
+	scores = {}
+	for f in futures:
+		postings = f.get_result()
+		if not postings:
+			continue
+		idf = math.log(1.0 + float(POSTINGS_LIMIT) / len(postings))
+		for p in postings:
+			tag = p.key.parent().id()
+			scores[tag] = scores.get(tag, 0.0) + (1.0 + math.log(p.tf)) * idf
+	ranked = sorted(scores.iteritems(), key=lambda s: (-s[1], s[0]))[:limit]
+	pages = ndb.get_multi([ndb.Key(Page, tag) for tag, score in ranked])
+	results = []
+	for (tag, score), page in zip(ranked, pages):
+		if page:
+			results.append({'tag': tag,
+							'title': underscore_to_space(tag),
+							'score': score,
+							'snippet': snippet(page.content or '', tokens)})
+	return results
+
+# The snippet function returns the part of the text around the first query token found.
+SNIPPET_LENGTH = 200
+
+def snippet(text, tokens):
+	lower = text.lower()
+	found = [i for i in (lower.find(t) for t in tokens) if i >= 0]
+	start = max(min(found) - SNIPPET_LENGTH / 4, 0) if found else 0
+	s = ' '.join(text[start:start + SNIPPET_LENGTH].split())
+	if start > 0:
+		s = '...' + s
+	if start + SNIPPET_LENGTH < len(text):
+		s += '...'
+	return s
+
+
+# The migrate_search_index function indexes the pages saved before the search index existed.
+# Pages are indexed in batches; the urlsafe cursor for the next batch is returned (None when
+# every page is indexed).
+def migrate_search_index(cursor = None, batch = 20):
+	cursor = Cursor(urlsafe=cursor) if cursor else None
+	keys, cursor, more = Page.query().fetch_page(batch, start_cursor=cursor, keys_only=True)
+	for key in keys:
+		index_page(key.id())
+	return cursor.urlsafe() if more else None
@@ -0,0 +1,113 @@
+# stats.py
+# This .py file contains the request and datastore/memcache instrumentation.
+# Every request (by route) and every instrumented helper (see timed) records:
+#   -- wall time in milliseconds
+#   -- number of datastore RPCs
+#   -- number of memcache RPCs, and the number of memcache keys found (hits) and not found
+#      (misses) by memcache gets
+# RPCs are counted with App Engine API call hooks, so RPCs made by ndb itself (including its
+# own memcache use) are counted too. The most recent SAMPLES samples of each route and helper
+# are kept in memory and summarized as percentiles by summary() (the /_stats route).
+# Improvements:
+#	(1) Samples are kept per instance. Aggregate across instances (memcache or logs)?
+
+import threading
+import time
+from collections import deque
+from functools import wraps
+from google.appengine.api import apiproxy_stub_map
+
+SAMPLES = 1000
+PERCENTILES = [50, 90, 99]
+FIELDS = ['ms', 'datastore', 'memcache', 'memcache_hits', 'memcache_misses']
+
+_local = threading.local()
+_lock = threading.Lock()
+_samples = {}
+
+
+# Counters
+# The counters of the current request are a dictionary of FIELDS (other than 'ms') stored in
+# thread local storage (requests are handled in separate threads).
+def counters():
+	if not hasattr(_local, 'counters'):
+		_local.counters = dict((f, 0) for f in FIELDS[1:])
+	return _local.counters
+
+def _count(field, n = 1):
+	c = counters()
+	c[field] += n
+
+def _pre_call_hook(service, call, request, response):
+	if service == 'datastore_v3':
+		_count('datastore')
+	elif service == 'memcache':
+		_count('memcache')
+
+def _post_call_hook(service, call, request, response):
+	if service == 'memcache' and call == 'Get':
+		hits = response.item_size()
+		_count('memcache_hits', hits)
+		_count('memcache_misses', request.key_size() - hits)
+
+# The install function adds the RPC hooks (once per instance)
+def install():
+	apiproxy = apiproxy_stub_map.apiproxy
+	apiproxy.GetPreCallHooks().Append('wiki_stats', _pre_call_hook)
+	apiproxy.GetPostCallHooks().Append('wiki_stats', _post_call_hook)
+
+
+# Samples
+# A Timer measures the wall time and the RPCs made between start and stop.
+class Timer(object):
+	def __init__(self):
+		self.start = time.time()
+		self.counts = dict(counters())
+
+	def stop(self):
+		sample = dict((f, n - self.counts[f]) for f, n in counters().iteritems())
+		sample['ms'] = (time.time() - self.start) * 1000
+		return sample
+
+def record(name, sample):
+	with _lock:
+		if name not in _samples:
+			_samples[name] = deque(maxlen=SAMPLES)
+		_samples[name].append(sample)
+
+# The timed decorator records a sample named name for every call of the decorated function
+def timed(name):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(*a, **kw):
+			timer = Timer()
+			try:
+				return func(*a, **kw)
+			finally:
+				record(name, timer.stop())
+		return wrapper
+	return decorator
+
+# The summary function returns {name: {'count': n, field: {'p50': ..., 'mean': ...}, ...}}
+# for every route and helper that has samples.
+def summary():
+	with _lock:
+		samples = dict((name, list(s)) for name, s in _samples.iteritems())
+	return dict((name, _summarize(s)) for name, s in samples.iteritems())
+
+def _summarize(samples):
+	d = {'count': len(samples)}
+	for f in FIELDS:
+		values = sorted(s[f] for s in samples)
+		d[f] = dict(('p%d' % p, values[min(len(values) * p / 100, len(values) - 1)])
+					for p in PERCENTILES)
+		d[f]['mean'] = float(sum(values)) / len(values)
+	return d
+
+def reset():
+	with _lock:
+		_samples.clear()
+
+# The header function formats a sample for the X-Wiki-Stats response header
+def header(sample):
+	return '; '.join('%s=%s' % (f, int(round(sample[f]))) for f in FIELDS)
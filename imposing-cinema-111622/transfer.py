@@ -0,0 +1,172 @@
+# transfer.py
+# This .py file contains the bulk export and import of wiki pages and their revisions.
+# The wiki is exported as JSON Lines, one record per line:
+#   -- {"type": "page", "tag": ..., "owner": ..., "created": ...}
+#   -- {"type": "revision", "tag": ..., "revision": n, "author": ..., "created": ...,
+#       "content": ...} for every revision of the page (oldest first, n = 1, 2, 3, ...)
+#   -- {"type": "next", "position": ...} as the last line if the export is not complete. The
+#      export continues from the position (/_admin/export?position=...).
+# Each export request returns at most EXPORT_BYTES of JSON Lines (non-ASCII characters take
+# 6 bytes as \uXXXX escapes). The python27 runtime buffers the whole response and limits it
+# to 32 MB, so EXPORT_BYTES leaves room for the largest revision line. Pages and revisions are
+# read with batched query iterators and delta revisions are rebuilt from the previous
+# revision, so the export uses constant memory however long the page histories are. Pages are
+# read with a projection query (without the up to 1 MB content copy) and revisions
+# REVISION_BATCH at a time, as a snapshot revision can be as large as a page.
+# An import stores the uploaded records in ImportChunk entities, which are then imported one
+# at a time (in order) from the task queue with put_multi. Created timestamps and authors are
+# preserved; Page.modified is set to the time of the import. A chunk with revisions of a page
+# that has not been imported yet (an export part imported before the previous part's import
+# is complete) fails and is retried by the task queue.
+
+import base64
+import json
+from datetime import datetime
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from entities import Page, Content, content_texts
+from utils import apply_delta
+
+TIME_FMT = '%Y-%m-%dT%H:%M:%S.%f'
+EXPORT_BYTES = 8 * 1024 * 1024
+EXPORT_BATCH = 50
+REVISION_BATCH = 5
+IMPORT_CHUNK_BYTES = 512 * 1024
+IMPORT_BATCH = 10
+
+
+# Export
+
+# The export_lines function yields the export as JSON Lines starting at the position (None
+# for the beginning of the export).
+def export_lines(position = None):
+	page_cursor, revision_cursor, n = _decode_position(position)
+	size = 0
+	pages = Page.query().iter(projection=[Page.tag, Page.owner, Page.created],
+							  start_cursor=page_cursor, produce_cursors=True,
+							  batch_size=EXPORT_BATCH)
+	for page in pages:
+		page_position = pages.cursor_before()
+		if not revision_cursor:
+			line = _line({'type': 'page',
+						  'tag': page.tag,
+						  'owner': page.owner,
+						  'created': page.created.strftime(TIME_FMT)})
+			size += len(line)
+			yield line
+		revisions = Content.query(ancestor=page.key).order(Content.created).iter(
+			start_cursor=revision_cursor, produce_cursors=True, batch_size=REVISION_BATCH)
+		text = None
+		for c in revisions:
+			# a delta revision is rebuilt from the previous revision (one get_multi if the
+			# export resumes at a delta revision)
+			if c.delta is not None and text is not None:
+				text = apply_delta(text, c.delta)
+			else:
+				text = content_texts([c])[0]
+			line = _line({'type': 'revision',
+						  'tag': page.tag,
+						  'revision': n + 1,
+						  'author': c.author,
+						  'created': c.created.strftime(TIME_FMT),
+						  'content': text})
+			if size and size + len(line) > EXPORT_BYTES:
+				yield _line({'type': 'next',
+							 'position': _encode_position(page_position,
+														  revisions.cursor_before(), n)})
+				return
+			n += 1
+			size += len(line)
+			yield line
+		revision_cursor, n = None, 0
+
+def _line(record):
+	return json.dumps(record) + '\n'
+
+# A position is the cursor of the page query at the page being exported, the cursor of the
+# page's revision query and the number of revisions of the page exported so far.
+def _encode_position(page_cursor, revision_cursor, n):
+	return base64.urlsafe_b64encode(json.dumps([page_cursor.urlsafe(),
+												revision_cursor.urlsafe(), n]))
+
+def _decode_position(position):
+	if not position:
+		return None, None, 0
+	page_cursor, revision_cursor, n = json.loads(base64.urlsafe_b64decode(str(position)))
+	return Cursor(urlsafe=page_cursor), Cursor(urlsafe=revision_cursor), n
+
+
+# Import
+
+# ImportChunk entity
+# The ImportChunk entity stores part of an uploaded import (JSON Lines). It is keyed by the
+# import job and chunk number ('<job>-<n>').
+class ImportChunk(ndb.Model):
+	data = ndb.BlobProperty(compressed = True)
+
+def chunk_key(job, n):
+	return ndb.Key(ImportChunk, '%s-%d' % (job, n))
+
+# The store_import function stores the lines of an upload as ImportChunk entities of about
+# IMPORT_CHUNK_BYTES (IMPORT_BATCH chunks per put_multi) and returns the number of chunks.
+# Records of one page may be split across chunks; chunks are imported in order.
+def store_import(job, lines):
+	n, batch = 0, []
+	for data in _chunks(lines):
+		batch.append(ImportChunk(key=chunk_key(job, n), data=data))
+		n += 1
+		if len(batch) == IMPORT_BATCH:
+			ndb.put_multi(batch)
+			batch = []
+	ndb.put_multi(batch)
+	return n
+
+def _chunks(lines):
+	data, size = [], 0
+	for line in lines:
+		if not line.strip():
+			continue
+		data.append(line)
+		size += len(line)
+		if size >= IMPORT_CHUNK_BYTES:
+			yield ''.join(data)
+			data, size = [], 0
+	if data:
+		yield ''.join(data)
+
+# The import_chunk function imports chunk n of the job and returns the tags of the imported
+# pages (None if there is no such chunk).
+def import_chunk(job, n):
+	chunk = chunk_key(job, n).get()
+	if not chunk:
+		return None
+	records = [json.loads(line) for line in chunk.data.splitlines() if line.strip()]
+	records = [r for r in records if r['type'] in ('page', 'revision')]
+	tags = []
+	for r in records:
+		if r['tag'] not in tags:
+			tags.append(r['tag'])
+	for tag in tags:
+		_import_page(tag, [r for r in records if r['tag'] == tag])
+	return tags
+
+def delete_chunk(job, n):
+	chunk_key(job, n).delete()
+
+# Revisions are numbered in the export, so a chunk that is imported again (a retried task)
+# skips the revisions the page already has. Pages should be imported into a wiki where they
+# do not exist yet.
+@ndb.transactional
+def _import_page(tag, records):
+	p = Page.by_tag(tag)
+	entities = []
+	for r in records:
+		created = datetime.strptime(r['created'], TIME_FMT)
+		if r['type'] == 'page' and not p:
+			p = Page(id=tag, tag=tag, owner=r['owner'], created=created, edits=0)
+		elif r['type'] == 'revision' and not p:
+			raise ValueError('revision %d of %s imported before its page' % (r['revision'], tag))
+		elif r['type'] == 'revision' and r['revision'] > p.edits:
+			entities.append(p.add_revision(r['content'], r['author'], created))
+	if p:
+		ndb.put_multi([p] + entities)
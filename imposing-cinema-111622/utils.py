@@ -5,6 +5,7 @@
 import re
 import hmac, random, string
 import hashlib
+import difflib
 
 # Form validation functions
 # Improvements:
@@ -57,4 +58,24 @@ def valid_pw(name, pw, h):
 
 # String parsing
 def underscore_to_space(s):
-	return string.replace(s, '_', ' ')
\ No newline at end of file
+	return string.replace(s, '_', ' ')
+
+
+# Line deltas
+# A delta is a list of operations that rebuilds a new text from an old text:
+#   -- [i, j] copies lines i to j of the old text
+#   -- a string is inserted as is
+def make_delta(old, new):
+	a, b = old.splitlines(True), new.splitlines(True)
+	delta = []
+	for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b).get_opcodes():
+		if op == 'equal':
+			delta.append([i1, i2])
+		elif j2 > j1:
+			delta.append(''.join(b[j1:j2]))
+	return delta
+
+def apply_delta(old, delta):
+	a = old.splitlines(True)
+	return ''.join(op if isinstance(op, basestring) else ''.join(a[op[0]:op[1]])
+				   for op in delta)